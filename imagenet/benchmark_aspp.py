@@ -0,0 +1,74 @@
+"""DeepLab_Classifier_Module (ASPP) benchmark, separate vs fused branches
+
+Times the four dilated 3x3 branches (6/12/18/24) as separate convs summed
+with += (fused = 0) against the fused single 1x1 conv + shifted sum
+(fused = 2, fused in backward too), on the top feature map of a VOC-sized
+input, and reports the max output difference.
+
+Usage (from imagenet/):
+    python benchmark_aspp.py --size 513 --topfeatures 2048 --batch-sizes 1,4
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import torch
+
+import resnext
+
+
+def timeit(fn, repeats, cuda=False):
+    out = fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return out, (time.time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ASPP separate vs fused branches')
+    parser.add_argument('--size', default=513, type=int, help='input image size, VOC crops are 513')
+    parser.add_argument('--topfeatures', default=2048, type=int, help='channels of the top feature map')
+    parser.add_argument('--nclass', default=21, type=int)
+    parser.add_argument('--batch-sizes', default='1,4', type=str)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--backward', default=0, type=int, help='also time forward + backward')
+    args = parser.parse_args()
+
+    dilations = [6, 12, 18, 24]
+    aspp = resnext.DeepLab_Classifier_Module(args.topfeatures, dilations, dilations, args.nclass).to(args.device)
+    cuda = args.device.startswith('cuda')
+    mapsize = resnext.outS(args.size)
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        x = torch.randn(batch_size, args.topfeatures, mapsize, mapsize, device=args.device,
+                        requires_grad=bool(args.backward))
+        times, outs = [], []
+        for fused in [0, 2]:
+            aspp.fused = fused
+
+            def step():
+                if args.backward:
+                    out = aspp(x)
+                    out.sum().backward()
+                    return out.detach()
+                with torch.no_grad():
+                    return aspp(x)
+
+            out, t = timeit(step, args.repeats, cuda)
+            outs.append(out)
+            times.append(t)
+        print('size={0} map={1}x{1} c={2} nclass={3} b={4:<3d} separate {5:8.2f} ms  fused {6:8.2f} ms  '
+              '({7:.2f}x)  max abs error {8:.2e}'.format(args.size, mapsize, args.topfeatures, args.nclass,
+                                                          batch_size, times[0] * 1000, times[1] * 1000,
+                                                          times[0] / times[1],
+                                                          float((outs[0] - outs[1]).abs().max())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Throughput of ResNeXt in NCHW vs channels-last (NHWC) memory format
+
+For every x/d setting and batch size, builds the same model with
+channels_last = 0 and 1 and reports the images/sec of eval forward and of a
+training step (forward + backward), plus the max output difference.
+
+Usage (from imagenet/):
+    python benchmark_channels_last.py --arch resnext_imagenet1k --xd 32x4,64x4 --batch-sizes 16,64
+    python benchmark_channels_last.py --arch resnext29_cifar100 --size 32 --xd 8x64,16x64
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import torch
+
+import resnext
+
+
+def throughput(model, x, repeats, train=False):
+    model.train(train)
+
+    def step():
+        if train:
+            model.zero_grad()
+            model(x).float().sum().backward()
+        else:
+            with torch.no_grad():
+                return model(x)
+
+    out = step()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        step()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return out, x.size(0) * repeats / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ResNeXt NCHW vs channels-last throughput')
+    parser.add_argument('--arch', default='resnext_imagenet1k', type=str)
+    parser.add_argument('--numlayers', default=50, type=int)
+    parser.add_argument('--size', default=224, type=int, help='input height and width')
+    parser.add_argument('--xd', default='32x4,64x4', type=str, help='comma separated XxD settings')
+    parser.add_argument('--batch-sizes', default='8,32', type=str)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--train', default=1, type=int, help='also time a training step')
+    args = parser.parse_args()
+
+    lastout = args.size // 32 + (1 if 'cifar' in args.arch else 0)
+    for xd in args.xd.split(','):
+        x, d = [int(v) for v in xd.split('x')]
+        models = []
+        for channels_last in [0, 1]:
+            torch.manual_seed(0)
+            models.append(getattr(resnext, args.arch)(numlayers=args.numlayers, x=x, d=d, lastout=lastout,
+                                                      channels_last=channels_last).to(args.device))
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            input = torch.randn(batch_size, 3, args.size, args.size, device=args.device)
+            ref, nchw = throughput(models[0], input, args.repeats)
+            out, nhwc = throughput(models[1], input, args.repeats)
+            line = '{0} x={1} d={2} b={3:<4d} eval {4:8.1f} -> {5:8.1f} img/s ({6:.2f}x)'.format(
+                args.arch, x, d, batch_size, nchw, nhwc, nhwc / nchw)
+            if args.train:
+                _, nchw = throughput(models[0], input, args.repeats, train=True)
+                _, nhwc = throughput(models[1], input, args.repeats, train=True)
+                line += '  train {0:8.1f} -> {1:8.1f} img/s ({2:.2f}x)'.format(nchw, nhwc, nhwc / nchw)
+            print(line + '  max abs error {0:.2e}'.format(float((ref - out).abs().max())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Fused DeformConv2d vs ConvOffset2D followed by a grouped nn.Conv2d
+
+The two deformable conv2 layouts of NeXtBottleneck (--fdf 1 / --fdf 0), at the
+same channels, groups and map size. Reports the eval and training step time,
+the parameter count and the memory: on CUDA the peak allocated, on CPU the
+largest single allocation of a step (from the profiler).
+
+DeformConv2d samples once per kernel tap (k*k offset fields) where ConvOffset2D
+samples the map once, so it does k*k times the sampling, one tap at a time.
+
+Usage (from imagenet/):
+    python benchmark_deform.py --channels 256 --size 28 --batch-sizes 8 --groups 32
+    python benchmark_deform.py --channels 128,256 --size 56,28 --og 1,4 --device cuda
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from torch_deform_conv.layers import ConvOffset2D, DeformConv2d
+
+try:
+    from torch.profiler import profile, ProfilerActivity
+except ImportError:
+    profile = None
+
+
+def layers(channels, groups, offset_groups):
+    """(name, module) of both layouts, conv weights shared"""
+    conv = nn.Conv2d(channels, channels, 3, padding=1, groups=groups, bias=False)
+    unfused = nn.Sequential(ConvOffset2D(channels), conv)
+    fused = DeformConv2d(channels, channels, 3, padding=1, groups=groups, offset_groups=offset_groups)
+    fused.weight.data.copy_(conv.weight.data)
+    # Small non-zero offsets, so neither layer samples on the integer grid only
+    fused.offset_weight.data.normal_(0, 0.01)
+    return [('ConvOffset2D+Conv2d', unfused), ('DeformConv2d og={0}'.format(offset_groups), fused)]
+
+
+def measure(model, x, repeats, train=False):
+    """(ms per step, MB) of model on x"""
+    model.train(train)
+
+    def step():
+        if train:
+            model.zero_grad()
+            model(x.requires_grad_()).sum().backward()
+        else:
+            with torch.no_grad():
+                model(x)
+
+    cuda = x.is_cuda
+    step()
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    ms = (time.time() - start) / repeats * 1e3
+    if cuda:
+        return ms, torch.cuda.max_memory_allocated() / 2. ** 20
+    if profile is None:
+        return ms, float('nan')
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        step()
+    return ms, max(e.self_cpu_memory_usage for e in prof.events()) / 2. ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DeformConv2d vs ConvOffset2D + Conv2d')
+    parser.add_argument('--channels', default='256', type=str, help='comma separated, paired with --size')
+    parser.add_argument('--size', default='28', type=str, help='comma separated map sizes')
+    parser.add_argument('--groups', default=32, type=int)
+    parser.add_argument('--og', default='1', type=str, help='comma separated DeformConv2d offset_groups')
+    parser.add_argument('--batch-sizes', default='8', type=str)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--train', default=1, type=int, help='also time a training step')
+    args = parser.parse_args()
+
+    memory = 'peak MB' if args.device.startswith('cuda') else 'largest alloc MB'
+    for channels, size in zip([int(c) for c in args.channels.split(',')], [int(s) for s in args.size.split(',')]):
+        for offset_groups in [int(og) for og in args.og.split(',')]:
+            torch.manual_seed(0)
+            candidates = [(name, m.to(args.device)) for name, m in layers(channels, args.groups, offset_groups)]
+            for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+                x = torch.randn(batch_size, channels, size, size, device=args.device)
+                for name, model in candidates:
+                    params = sum(p.numel() for p in model.parameters())
+                    ms, mb = measure(model, x.clone(), args.repeats)
+                    line = 'c={0} {1}x{1} b={2:<4d} {3:22s} {4:8.3f} M params  eval {5:8.1f} ms {6:8.1f} {7}'.format(
+                        channels, size, batch_size, name, params / 1e6, ms, mb, memory)
+                    if args.train:
+                        ms, mb = measure(model, x.clone(), args.repeats, train=True)
+                        line += '  train {0:8.1f} ms {1:8.1f} {2}'.format(ms, mb, memory)
+                    print(line)
+
+
+if __name__ == '__main__':
+    main()
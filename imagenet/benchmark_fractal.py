@@ -0,0 +1,76 @@
+"""FAResNeXt fractal vs non-fractal block groups
+
+Builds the same FAResNeXt factory with verticalfrac = False and True (the
+weights are shared, FABigBlock keeps the nn.Sequential state_dict keys) and
+reports the eval and training step time, the most block outputs a fractal
+group holds at once, and on CUDA the peak allocated memory.
+
+Usage (from imagenet/):
+    python benchmark_fractal.py --arch faresnext50 --batch-sizes 8,32
+    python benchmark_fractal.py --arch faresnext101v2 --fracparam 3 --device cuda
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import torch
+
+import meta_model.FractAllNeXt as FractAllNeXt
+
+
+def timeit(model, x, repeats, train=False):
+    model.train(train)
+
+    def step():
+        if train:
+            model.zero_grad()
+            model(x).sum().backward()
+        else:
+            with torch.no_grad():
+                return model(x)
+
+    cuda = x.is_cuda
+    out = step()
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2. ** 20 if cuda else float('nan')
+    return out, (time.time() - start) / repeats, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FAResNeXt fractal vs non-fractal block groups')
+    parser.add_argument('--arch', default='faresnext50', type=str, help='factory in meta_model/FractAllNeXt.py')
+    parser.add_argument('--fracparam', default=2, type=int)
+    parser.add_argument('--batch-sizes', default='8', type=str)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--train', default=1, type=int, help='also time a training step')
+    args = parser.parse_args()
+
+    build = getattr(FractAllNeXt, args.arch)
+    plain = build(verticalfrac=False).to(args.device)
+    fractal = build(verticalfrac=True, fracparam=args.fracparam).to(args.device)
+    fractal.load_state_dict(plain.state_dict())
+    groups = [fractal.layer1, fractal.layer2, fractal.layer3, fractal.layer4]
+    print('{0} fracparam={1} max live block outputs per group: {2}'.format(
+        args.arch, args.fracparam, [group.max_live() for group in groups]))
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        x = torch.randn(batch_size, 3, 224, 224, device=args.device)
+        modes = [False, True] if args.train else [False]
+        for train in modes:
+            _, t0, m0 = timeit(plain, x, args.repeats, train)
+            _, t1, m1 = timeit(fractal, x, args.repeats, train)
+            print('b={0:<4d} {1:5s} non-fractal {2:8.2f} ms {3:8.1f} MB  fractal {4:8.2f} ms {5:8.1f} MB'.format(
+                batch_size, 'train' if train else 'eval', t0 * 1000, m0, t1 * 1000, m1))
+
+
+if __name__ == '__main__':
+    main()
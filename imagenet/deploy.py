@@ -0,0 +1,185 @@
+"""Deploy export of ResNeXt / MS_Deeplab models
+
+Traces a configured model in eval mode, so every Python branch on its
+configuration flags (attention, multiway, taskmode, deform, verticalfrac ...)
+is resolved once and baked into the graph, then freezes it into a TorchScript
+module or writes an ONNX file. The exported artifact is run on the example
+input (and on any extra check inputs) and compared against eager mode before
+it is returned.
+
+Usage (from imagenet/):
+    python deploy.py --arch resnext29_cifar100 --resume checkpoint.pth.tar --size 32 --out r29.pt
+    python deploy.py --arch resnext_imagenet1k --format onnx --out r50.onnx
+    python deploy.py --seg --nclass 21 --size 321 --out deeplab.pt
+
+BatchNorm is folded into the preceding convs first (--fuse 1, see fuse.py).
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+
+import torch
+
+import resnext
+from fuse import fuse_for_inference
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def _flatten(out):
+    """Model output as a flat list of tensors, MS_Deeplab returns a list"""
+    if isinstance(out, (list, tuple)):
+        return [t for o in out for t in _flatten(o)]
+    return [out]
+
+
+def check_outputs(ref, out, rtol=1e-4, atol=1e-5):
+    """Max abs error between two model outputs, raises if they do not match"""
+    ref, out = _flatten(ref), _flatten(out)
+    if len(ref) != len(out):
+        raise RuntimeError('Exported model returns {0} outputs, eager returns {1}'.format(len(out), len(ref)))
+    max_err = 0.
+    for r, o in zip(ref, out):
+        o = torch.as_tensor(o).to(r.device, r.dtype)
+        if r.shape != o.shape:
+            raise RuntimeError('Output shape mismatch: {0} vs {1}'.format(tuple(o.shape), tuple(r.shape)))
+        max_err = max(max_err, float((r - o).abs().max()) if r.numel() else 0.)
+        if not torch.allclose(r, o, rtol=rtol, atol=atol):
+            raise RuntimeError('Exported model differs from eager mode, max abs error {0:.3g}'.format(max_err))
+    return max_err
+
+
+def export_torchscript(model, example, path=None, check_inputs=(), rtol=1e-4, atol=1e-5):
+    """Trace + freeze an eval-mode model, verify it against eager mode
+
+    Returns (frozen ScriptModule, max abs error). Saved to path if given.
+    The graph is specialized to the flags of model, and to the input size for
+    models whose deformable grids or interpolation sizes depend on it.
+    """
+    model.eval()
+    inputs = [example] + list(check_inputs)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_trace=False)
+        traced = torch.jit.freeze(traced)
+        max_err = 0.
+        for x in inputs:
+            max_err = max(max_err, check_outputs(model(x), traced(x), rtol, atol))
+    if path:
+        traced.save(path)
+    return traced, max_err
+
+
+def export_onnx(model, example, path, check_inputs=(), rtol=1e-4, atol=1e-5, opset_version=17):
+    """Write model to an ONNX file, verify it with onnxruntime when installed
+
+    Returns the max abs error, or None when onnxruntime is not available.
+    """
+    model.eval()
+    with torch.no_grad():
+        ref = model(example)
+        n_out = len(_flatten(ref))
+        output_names = ['output'] if n_out == 1 else ['output_{0}'.format(i) for i in range(n_out)]
+        torch.onnx.export(model, example, path, input_names=['input'], output_names=output_names,
+                          opset_version=opset_version)
+
+    if onnxruntime is None:
+        print('=> onnxruntime not installed, {0} is not verified'.format(path))
+        return None
+
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    max_err = 0.
+    with torch.no_grad():
+        for x in [example] + list(check_inputs):
+            out = session.run(None, {'input': x.cpu().numpy()})
+            max_err = max(max_err, check_outputs(_flatten(model(x)), [torch.from_numpy(o) for o in out],
+                                                 rtol, atol))
+    return max_err
+
+
+def export_model(model, example, path=None, format='torchscript', **kwargs):
+    """Deploy-export entry point: format is 'torchscript' or 'onnx'
+
+    Returns (artifact, max abs error), artifact is the frozen ScriptModule or
+    the ONNX path.
+    """
+    if format == 'torchscript':
+        return export_torchscript(model, example, path, **kwargs)
+    elif format == 'onnx':
+        if path is None:
+            raise ValueError('ONNX export needs a path')
+        return path, export_onnx(model, example, path, **kwargs)
+    raise ValueError('Unknown export format: {0}'.format(format))
+
+
+def load_checkpoint(model, path):
+    """Loads a main_next.py checkpoint, with or without the DataParallel prefix"""
+    checkpoint = torch.load(path, map_location='cpu')
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    state_dict = dict((k[len('module.'):] if k.startswith('module.') else k, v)
+                      for k, v in state_dict.items())
+    model.load_state_dict(state_dict)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ResNeXt / MS_Deeplab deploy export')
+    parser.add_argument('--arch', default='resnext_imagenet1k', type=str,
+                        help='factory in resnext.py, e.g. resnext29_cifar100, resnext_imagenet1k')
+    parser.add_argument('--seg', default=0, type=int, help='Export MS_Deeplab instead of --arch')
+    parser.add_argument('--resume', default='', type=str, metavar='PATH', help='checkpoint to load')
+    parser.add_argument('--format', default='torchscript', type=str, help='torchscript | onnx')
+    parser.add_argument('--out', default='model.pt', type=str, metavar='PATH')
+    parser.add_argument('--size', default=224, type=int, help='input height and width')
+    parser.add_argument('-b', '--batch-size', default=1, type=int)
+    parser.add_argument('--nclass', '--num-classes', default=21, type=int, help='MS_Deeplab classes')
+    parser.add_argument('--numlayers', default=50, type=int)
+    parser.add_argument('--xp', '--expansion-coef', default=2, type=float)
+    parser.add_argument('--x', '--num-channels', default=32, type=int)
+    parser.add_argument('--d', '--channel-width', default=4, type=int)
+    parser.add_argument('--lastout', default=7, type=int)
+    parser.add_argument('--att', '--attention-model', default=0, type=int)
+    parser.add_argument('--dp', default='', type=str, help='Dilation Pattern')
+    parser.add_argument('--df', default=0.0, type=float, help='Deformable Flag')
+    parser.add_argument('--og', '--offset-groups', default=None, type=int,
+                        help='offset fields, 0: one per channel, N: N fields; '
+                             'unset: one per channel, or one shared with --fdf 1')
+    parser.add_argument('--fdf', '--fused-deform', default=0, type=int,
+                        help='DeformConv2d conv2, one shared offset field unless --og is set')
+    parser.add_argument('--fixx', default=1, type=int)
+    parser.add_argument('--sqex', default=0, type=int)
+    parser.add_argument('--ratt', default=0, type=int)
+    parser.add_argument('--fuse', default=1, type=int, help='Fold BatchNorm into convs before export')
+    parser.add_argument('--rtol', default=1e-4, type=float)
+    parser.add_argument('--atol', default=1e-5, type=float)
+    args = parser.parse_args()
+
+    kwargs = dict(deform=args.df, fixx=args.fixx, att=True if args.att else False,
+                  offset_groups=args.og, fusedeform=args.fdf)
+    if args.seg:
+        model = resnext.MS_Deeplab(resnext.NeXtBottleneck, args.numlayers, args.x * args.d / 128.0, args.x / 32.0,
+                                   args.nclass, args.xp, dilpat=args.dp or 'DEEPLAB', **kwargs)
+    else:
+        if 'cifar' in args.arch:
+            args.lastout += 1
+        model = getattr(resnext, args.arch)(numlayers=args.numlayers, expansion=args.xp, x=args.x, d=args.d,
+                                           lastout=args.lastout, dilpat=args.dp,
+                                           sqex=args.sqex, ratt=args.ratt, **kwargs)
+    if args.resume:
+        if not os.path.isfile(args.resume):
+            raise IOError("no checkpoint found at '{0}'".format(args.resume))
+        load_checkpoint(model, args.resume)
+    if args.fuse:
+        model, n = fuse_for_inference(model)
+        print('=> folded {0} BatchNorm2d layers'.format(n))
+
+    example = torch.randn(args.batch_size, 3, args.size, args.size)
+    _, max_err = export_model(model, example, args.out, format=args.format, rtol=args.rtol, atol=args.atol)
+    print("=> exported '{0}' ({1}), max abs error vs eager: {2}".format(args.out, args.format, max_err))
+
+
+if __name__ == '__main__':
+    main()
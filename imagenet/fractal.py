@@ -0,0 +1,60 @@
+"""Vertical fractal skips of a block group, shared by ResNeXt and FAResNeXt
+
+Block idx of a group reads the output of block idx-1 and adds the outputs of
+blocks idx - fracparam**k, k >= 1, down to block first_skip. The topology is
+compiled once into a plan, one (src, skips, frees) per block: block idx reads
+out[src] (src = -1 is the group input), adds out[j] for j in skips, then
+out[j] for j in frees can be released, this block is their last consumer.
+
+    plan = make_plan(len(blocks), fracparam)
+    out = run_plan(blocks, plan, {-1: x})
+"""
+from __future__ import absolute_import, division
+
+
+def make_plan(blocks, fracparam, first_skip=0):
+    """Fractal skip plan of a group of blocks, skips to blocks before first_skip are left out"""
+    assert fracparam > 1
+    steps = []
+    for idx in range(blocks):
+        skips = []
+        dist = fracparam
+        while idx - dist >= first_skip:
+            skips.append(idx - dist)
+            dist *= fracparam
+        steps.append((idx - 1, skips))
+
+    last_use = {}
+    for idx, (src, skips) in enumerate(steps):
+        for j in [src] + skips:
+            last_use[j] = idx
+    return [(src, skips, [j for j in [src] + skips if last_use[j] == idx])
+            for idx, (src, skips) in enumerate(steps)]
+
+
+def run_plan(blocks, plan, outs, start=0, end=None):
+    """
+    Runs blocks [start, end) along plan, outs = {idx: output} holds the live intermediates
+    (-1: the group input) and is updated in place, an intermediate is dropped as soon as
+    its last consumer ran. Returns outs.
+    """
+    end = len(plan) if end is None else end
+    for idx in range(start, end):
+        src, skips, frees = plan[idx]
+        out = blocks[idx](outs[src])
+        for j in skips:
+            out = out + outs[j]
+        for j in frees:
+            del outs[j]
+        outs[idx] = out
+    return outs
+
+
+def max_live(plan):
+    """Most block outputs held at once by run_plan, the group input and result included"""
+    live, peak = 1, 1
+    for src, skips, frees in plan:
+        live += 1
+        peak = max(peak, live)
+        live -= len(frees)
+    return peak
@@ -0,0 +1,173 @@
+"""Conv-BN folding for inference
+
+fuse_for_inference folds every BatchNorm2d of a resnext.py model that directly
+follows a plain nn.Conv2d into that conv's weight and bias, and replaces the
+BatchNorm2d by nn.Identity. Folding is per output channel, so grouped and
+dilated convs fold the same way. Covered:
+
+    ResNeXt / ResNet stem       conv1 -> bn1
+    NeXtBottleneck              conv1/bn1, conv2/bn2, conv3/bn3, secord branch
+    IRNeXt                      conv11/bn11, conv21/bn21, conv22/bn22, conv3/bn31,
+                                bn30 after the concat split over conv12 and conv23
+    BasicBlock / Bottleneck     conv1/bn1, conv2/bn2 (, conv3/bn3)
+    nn.Sequential               Conv2d followed by BatchNorm2d, e.g. downsample
+
+Anything else is left alone: DeformConv2d / ConvOffset2D, BN without running
+statistics, and BN whose input is not a plain conv output.
+
+Usage (from imagenet/), reports the eval latency before and after folding:
+    python fuse.py --batch-sizes 1,32 --repeats 20
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+import resnext
+
+
+# (conv, bn) attribute pairs where forward applies bn directly to the conv output
+_FOLD_PAIRS = {
+    resnext.ResNeXt: [('conv1', 'bn1')],
+    resnext.ResNet: [('conv1', 'bn1')],
+    resnext.BasicBlock: [('conv1', 'bn1'), ('conv2', 'bn2')],
+    resnext.Bottleneck: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+    resnext.NeXtBottleneck: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'),
+                             ('conv1_secord2', 'bn1_secord2'), ('conv2_secord2', 'bn2_secord2')],
+    resnext.IRNeXt: [('conv11', 'bn11'), ('conv21', 'bn21'), ('conv22', 'bn22'), ('conv3', 'bn31')],
+}
+
+# bn applied to torch.cat of several conv outputs along channels
+_FOLD_CONCATS = {
+    resnext.IRNeXt: [(('conv12', 'conv23'), 'bn30')],
+}
+
+
+def _foldable_conv(conv):
+    # ConvOffset2D subclasses nn.Conv2d but its output is not the conv output
+    return type(conv) is nn.Conv2d
+
+
+def _foldable_bn(bn):
+    return isinstance(bn, nn.BatchNorm2d) and bn.running_mean is not None and bn.running_var is not None
+
+
+def fold_conv_bn(conv, bn, start=0):
+    """Folds channels [start, start + conv.out_channels) of bn into conv, in place"""
+    end = start + conv.out_channels
+    std = (bn.running_var[start:end] + bn.eps).sqrt()
+    scale = bn.weight[start:end] / std if bn.affine else 1. / std
+    shift = -bn.running_mean[start:end] * scale
+    if bn.affine:
+        shift = shift + bn.bias[start:end]
+
+    weight = conv.weight.data
+    conv.weight.data = weight * scale.to(weight.dtype).view(-1, 1, 1, 1)
+    if conv.bias is None:
+        conv.bias = nn.Parameter(shift.to(weight.dtype))
+    else:
+        conv.bias.data = conv.bias.data * scale.to(weight.dtype) + shift.to(weight.dtype)
+    return conv
+
+
+def _fuse_sequential(seq):
+    n = 0
+    for i in range(len(seq) - 1):
+        if _foldable_conv(seq[i]) and _foldable_bn(seq[i + 1]) \
+                and seq[i].out_channels == seq[i + 1].num_features:
+            fold_conv_bn(seq[i], seq[i + 1])
+            seq[i + 1] = nn.Identity()
+            n += 1
+    return n
+
+
+def _fuse_pairs(module, pairs):
+    n = 0
+    for conv_name, bn_name in pairs:
+        conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+        if _foldable_conv(conv) and _foldable_bn(bn) and conv.out_channels == bn.num_features:
+            fold_conv_bn(conv, bn)
+            setattr(module, bn_name, nn.Identity())
+            n += 1
+    return n
+
+
+def _fuse_concats(module, concats):
+    n = 0
+    for conv_names, bn_name in concats:
+        convs = [getattr(module, name, None) for name in conv_names]
+        bn = getattr(module, bn_name, None)
+        if all(_foldable_conv(conv) for conv in convs) and _foldable_bn(bn) \
+                and sum(conv.out_channels for conv in convs) == bn.num_features:
+            start = 0
+            for conv in convs:
+                fold_conv_bn(conv, bn, start)
+                start += conv.out_channels
+            setattr(module, bn_name, nn.Identity())
+            n += 1
+    return n
+
+
+def fuse_for_inference(model):
+    """Folds BatchNorm2d into the preceding conv, in place, see the module doc
+
+    The model is switched to eval mode, folding uses the running statistics.
+    Returns (model, number of BatchNorm2d layers folded)
+    """
+    model.eval()
+    n = 0
+    with torch.no_grad():
+        for module in list(model.modules()):
+            if type(module) in _FOLD_PAIRS:
+                n += _fuse_pairs(module, _FOLD_PAIRS[type(module)])
+            if type(module) in _FOLD_CONCATS:
+                n += _fuse_concats(module, _FOLD_CONCATS[type(module)])
+            if isinstance(module, nn.Sequential):
+                n += _fuse_sequential(module)
+    return model, n
+
+
+def timeit(model, x, repeats):
+    with torch.no_grad():
+        model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            out = model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+    return out, (time.time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Conv-BN folding latency report')
+    parser.add_argument('--batch-sizes', default='1,32', type=str)
+    parser.add_argument('--repeats', default=10, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--x', '--num-channels', default=32, type=int)
+    parser.add_argument('--d', '--channel-width', default=4, type=int)
+    args = parser.parse_args()
+
+    variants = [
+        ('resnext29_cifar100', 32, lambda: resnext.resnext29_cifar100(x=args.x, d=args.d, lastout=8)),
+        ('resnext_imagenet1k', 224, lambda: resnext.resnext_imagenet1k(numlayers=50, x=args.x, d=args.d)),
+    ]
+    for name, size, build in variants:
+        model = build().to(args.device).eval()
+        fused, n = fuse_for_inference(copy.deepcopy(model))
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            x = torch.randn(batch_size, 3, size, size, device=args.device)
+            ref, before = timeit(model, x, args.repeats)
+            out, after = timeit(fused, x, args.repeats)
+            print('{0:20s} b={1:<4d} folded {2:3d} BN  {3:8.2f} ms -> {4:8.2f} ms  ({5:+.1f}%)  max abs error {6:.2e}'
+                  .format(name, batch_size, n, before * 1000, after * 1000,
+                          100. * (before - after) / before, float((ref - out).abs().max())))
+
+
+if __name__ == '__main__':
+    main()
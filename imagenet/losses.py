@@ -0,0 +1,102 @@
+"""Soft-target losses of main_next.py, computed from integer labels
+
+Every loss takes (output, target) with target the (b,) class indices, takes
+one log-softmax of the logits and gathers the target log-probability, so no
+dense one-hot or soft target tensor is built:
+
+    LabelSmoothingLoss   --labelsm, smooth is set per epoch
+    FocalLoss            --focal
+    LabelBoostLoss       --labelboost, boosted weights in train mode, soft targets in eval mode
+    ProbabilityL1Loss    --L1 (smooth L1 on softmax * nclass) and the L1 archs (L1 on output)
+
+The multi-margin loss of --MarginP is nn.MultiMarginLoss, it already takes labels.
+"""
+from __future__ import absolute_import, division
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _gather(x, target):
+    """x[b, target[b]] for every row b"""
+    return x.gather(1, target.view(-1, 1)).squeeze(1)
+
+
+class LabelSmoothingLoss(nn.Module):
+    """
+    Cross entropy against smooth * onehot + (1 - smooth) / nclass, i.e.
+    -smooth * log p_y - (1 - smooth) / nclass * sum_c log p_c
+    """
+    def __init__(self, nclass, smooth = 1.0):
+        super(LabelSmoothingLoss, self).__init__()
+        self.nclass = nclass
+        self.smooth = smooth
+
+    def forward(self, output, target):
+        logp = F.log_softmax(output, dim=1)
+        loss = -self.smooth * _gather(logp, target)
+        if self.smooth != 1.0:
+            loss = loss - (1.0 - self.smooth) / self.nclass * logp.sum(1)
+        return loss.mean()
+
+
+class FocalLoss(nn.Module):
+    """Focal loss -(1 - p_y)**gamma * log p_y over the first nclass logits"""
+    def __init__(self, nclass, gamma = 2):
+        super(FocalLoss, self).__init__()
+        self.nclass = nclass
+        self.gamma = gamma
+
+    def forward(self, output, target):
+        logp_y = _gather(F.log_softmax(output[:, :self.nclass], dim=1), target)
+        return torch.mean((1.0 - logp_y.exp()) ** self.gamma * -logp_y)
+
+
+class LabelBoostLoss(nn.Module):
+    """
+    Boosted CNN loss over the first nclass logits.
+    Train mode: sum_b w_b * -log p_y, w = (1/nclass + p_y) ** (-1/labelboost) normalized to sum 1.
+    Eval mode: cross entropy against (onehot + labelboost * p) / (1 + labelboost).
+    """
+    def __init__(self, nclass, labelboost):
+        super(LabelBoostLoss, self).__init__()
+        self.nclass = nclass
+        self.labelboost = labelboost
+
+    def forward(self, output, target):
+        logp = F.log_softmax(output[:, :self.nclass], dim=1)
+        logp_y = _gather(logp, target)
+        if self.training:
+            w = (1.0 / self.nclass + logp_y.exp()) ** (-1.0 / self.labelboost)
+            w = w / torch.sum(w)
+            return torch.sum(w * -logp_y)
+        entropy = -torch.sum(logp.exp() * logp, 1)
+        return torch.mean((-logp_y + self.labelboost * entropy) / (1.0 + self.labelboost))
+
+
+class ProbabilityL1Loss(nn.Module):
+    """
+    Mean over all b x nclass entries of dist(scale * p - scale * onehot), p = softmax(output)
+    (softmax = False: p = output), dist smooth L1 (huber = True) or L1.
+    Summed as dist(scale * p) over all classes, corrected at the label, so no one-hot is built.
+    """
+    def __init__(self, nclass, softmax = True, huber = True, scale = None):
+        super(ProbabilityL1Loss, self).__init__()
+        self.nclass = nclass
+        self.softmax = softmax
+        self.huber = huber
+        self.scale = float(nclass) if scale is None else scale
+
+    def _dist(self, x):
+        if self.huber:
+            absx = x.abs()
+            return torch.where(absx < 1, 0.5 * x * x, absx - 0.5)
+        return x.abs()
+
+    def forward(self, output, target):
+        prob = F.softmax(output, dim=1) if self.softmax else output
+        x = prob * self.scale
+        x_y = _gather(x, target)
+        loss = self._dist(x).sum() + torch.sum(self._dist(x_y - self.scale) - self._dist(x_y))
+        return loss / x.numel()
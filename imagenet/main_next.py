@@ -16,8 +16,9 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 
-import resnext
-import meta_model.FractAllNeXt
+import registry
+import losses
+from torch_deform_conv.utils import set_offset_fast_path, offset_fast_path_stats
 
 
 
@@ -26,29 +27,14 @@ model_names = sorted(name for name in models.__dict__
     and callable(models.__dict__[name]))
 
 
-resnext_models = {'resnext50':resnext.resnext50,
-                  'resnext29_cifar10':resnext.resnext29_cifar10,
-                  'resnext_cifar100':resnext.resnext_cifar100,
-                  'resnext29_cifar100':resnext.resnext29_cifar100,
-                  'irnext29_cifar100':resnext.irnext29_cifar100,
-                  'irnext20_cifar100':resnext.irnext20_cifar100,
-                  #'resnext29_cifar100_bone':resnext.resnext29_cifar100_bone,
-                  'resnext_imagenet1k':resnext.resnext_imagenet1k,
-                  'resnext38_imagenet1k':resnext.resnext38_imagenet1k,
-                  'resnext50_imagenet1k':resnext.resnext50_imagenet1k,
-                  'resnext_inaturalist':resnext.resnext_inaturalist,
-                  'resnext38_inaturalist':resnext.resnext38_inaturalist,
-                  'resnext50_inaturalist':resnext.resnext50_inaturalist,
-                  'resnext50_cub200':resnext.resnext50_cub200}
-
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('data', metavar='DIR',
                     help='path to dataset')
 
 parser.add_argument('--arch', '-a', metavar='ARCH', default='faresnext50',
-                    choices=resnext_models.keys(),
+                    choices=registry.arch_names(),
                     help='model architecture: ' +
-                        ' | '.join(resnext_models.keys()) +
+                        ' | '.join(registry.arch_names()) +
                         ' (default: faresnext50)')
 
 parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
@@ -109,8 +95,12 @@ parser.add_argument('--ratt', '--residual-attentionsimple', default=0, type=int,
 
 
 
+parser.add_argument('--ser', '--se-reduction', default=1, type=int,
+                   metavar='N', help='Squeeze and Excitation Reduction Ratio, 1: Full Width')
+
 parser.add_argument('--labelsm' , default=0, type=int,
-                   metavar='N', help='Label Smoothing')
+                   metavar='N', help='Label Smoothing, takes precedence over the other loss modes; '
+                   'with an L1 arch, --L1, --labelboost or --focal the targets stay one-hot (cross entropy)')
 
 parser.add_argument('--labelboost' , default=0., type=float,
                    metavar='N', help='Label Boosting')
@@ -167,6 +157,26 @@ parser.add_argument('--dp', default='', type=str, metavar='Dilation Pattern (Ver
 parser.add_argument('--df', default=0.0, type=float, metavar='Deformable Flag',
                    help='Deformable Flag: Whether Deformable? May Cause Parameter Inflation')
 
+parser.add_argument('--og', '--offset-groups', default=None, type=int, metavar='N',
+                   help='Deformable Offset Fields, Each Shared By A Group Of Channels. 0: One Per Channel, '
+                        'N: N Fields, Same For --fdf 0 And 1. Unset: One Per Channel (--fdf 0), One Shared (--fdf 1)')
+
+parser.add_argument('--fdf', '--fused-deform', default=0, type=int, metavar='N',
+                   help='Fused Deformable: Sample Kernel Taps Inside conv2 (DeformConv2d) Instead Of ConvOffset2D. '
+                        'Defaults To One Shared Offset Field, Per-Channel Offsets Need --og 0')
+
+parser.add_argument('--fpt', '--fast-path-threshold', default=0.0, type=float, metavar='T',
+                   help='Deformable Eval Fast Path: Skip Sampling Where |Offsets| < T. 0: Off')
+
+parser.add_argument('--fptile', '--fast-path-tile', default=0, type=int, metavar='N',
+                   help='Deformable Eval Fast Path Tile Size. 0: Whole Map Only')
+
+parser.add_argument('--cl', '--channels-last', default=0, type=int, metavar='N',
+                   help='Channels Last (NHWC) Weights And Activations, Faster Grouped Convs')
+
+parser.add_argument('--cks', '--checkpoint-segments', default=0, type=int, metavar='N',
+                   help='Activation Checkpointing: Recompute N Segments Per Block Group In Backward. 0: Off')
+
 parser.add_argument('-e', '--evaluate', default=0, type=int, metavar='N',
                     help='evaluate model on validation set')
 
@@ -189,33 +199,37 @@ def main():
     # create model
     
     if 'cifar' in args.arch:
-        print "CIFAR Model Fix args.lastout As 8"
+        print("CIFAR Model Fix args.lastout As 8")
         args.lastout += 1
         
     
+    # Factories only take the arguments they know, see registry.build
+    model_kwargs = dict(numlayers = args.numlayers, expansion = args.xp, x = args.x, d = args.d, \
+                        upgroup = True if args.ug else False, downgroup = True if args.dg else False, \
+                        secord = True if args.secord else False, soadd = args.soadd, \
+                        att = True if args.att else False, lastout = args.lastout, dilpat = args.dp, \
+                        deform = args.df, fixx = args.fixx, sqex = args.sqex, ratt = args.ratt, \
+                        offset_groups = args.og, fusedeform = args.fdf, channels_last = args.cl, \
+                        checkpoint_segments = args.cks, sereduce = args.ser )
+    
     if args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
-        model = resnext_models[args.arch](pretrained=True, numlayers = args.numlayers,\
-                                          expansion = args.xp, x = args.x, d = args.d, \
-                                         upgroup = True if args.ug else False, downgroup = True if args.dg else False,\
-                                         secord = True if args.secord else False, soadd = args.soadd, \
-                                         att = True if args.att else False, lastout = args.lastout, dilpat = args.dp, \
-                                         deform = args.df, fixx = args.fixx, sqex = args.sqex , ratt = args.ratt )
-        
     else:
         print("=> creating model '{}'".format(args.arch))
-        model = resnext_models[args.arch](numlayers = args.numlayers, \
-                                          expansion = args.xp, x = args.x , d = args.d, \
-                                         upgroup = True if args.ug else False, downgroup = True if args.dg else False,\
-                                         secord = True if args.secord else False, soadd = args.soadd, \
-                                         att = True if args.att else False, lastout = args.lastout, dilpat = args.dp,
-                                         deform = args.df, fixx = args.fixx , sqex = args.sqex , ratt = args.ratt )
-        #print("args.df: {}".format(args.df))
-    
+    model = registry.build(args.arch, pretrained = args.pretrained, **model_kwargs)
     
-    # get the number of model parameters
-    print('Number of model parameters: {}'.format(
-        sum([p.data.nelement() for p in model.parameters()])))
+    # parameters, FLOPs and activations of one image, from the on-disk profile cache
+    # the profile is informative only, a config the meta-device pass cannot run still trains
+    try:
+        profile = registry.profile(args.arch, **model_kwargs)
+        print('Number of model parameters: {}, GFLOPs: {:.3f}, activations: {:.1f} MB'.format(
+            profile['params'], (profile['flops'] or 0) / 1e9, profile['activation_bytes'] / 2. ** 20))
+    except Exception as e:
+        print('=> profile failed ({}), counting parameters only'.format(e))
+        print('Number of model parameters: {}'.format(sum(p.numel() for p in model.parameters())))
+
+    if args.fpt > 0:
+        set_offset_fast_path(model, args.fpt, args.fptile)
     
     if args.arch.startswith('alexnet') or args.arch.startswith('vgg'):
         model.features = torch.nn.DataParallel(model.features)
@@ -237,7 +251,7 @@ def main():
             
             if args.finetune:
                 args.start_epoch = 0
-                print "start_epoch is ",args.start_epoch
+                print("start_epoch is {}".format(args.start_epoch))
                 topfeature = int(args.x * args.d * 8 * args.xp)
                 model.fc = nn.Linear(topfeature, args.nclass)
                 
@@ -261,7 +275,7 @@ def main():
 
         train_loader = torch.utils.data.DataLoader(
             datasets.ImageFolder(traindir, transforms.Compose([
-                transforms.RandomSizedCrop(args.lastout*32),
+                transforms.RandomResizedCrop(args.lastout*32),
                 transforms.RandomHorizontalFlip(),
                 transforms.ToTensor(),
                 normalize,
@@ -273,7 +287,7 @@ def main():
             
             val_loader = torch.utils.data.DataLoader(
                 datasets.ImageFolder(valdir, transforms.Compose([
-                    transforms.Scale((args.lastout+args.evalmodnum)*32),
+                    transforms.Resize((args.lastout+args.evalmodnum)*32),
                     transforms.CenterCrop(args.lastout*32),
                     transforms.RandomHorizontalFlip(),
                     transforms.ToTensor(),
@@ -286,7 +300,7 @@ def main():
             
             val_loader = torch.utils.data.DataLoader(
                 datasets.ImageFolder(valdir, transforms.Compose([
-                    transforms.Scale((args.lastout+args.evalmodnum)*32),
+                    transforms.Resize((args.lastout+args.evalmodnum)*32),
                     transforms.RandomCrop((args.lastout+args.evalmodnum)*32),
                     transforms.RandomCrop(args.lastout*32),
                     transforms.RandomHorizontalFlip(),
@@ -300,7 +314,7 @@ def main():
             
             val_loader = torch.utils.data.DataLoader(
                 datasets.ImageFolder(valdir, transforms.Compose([
-                    transforms.Scale((args.lastout+1)*32),
+                    transforms.Resize((args.lastout+1)*32),
                     transforms.CenterCrop(args.lastout*32),
                     transforms.ToTensor(),
                     normalize,
@@ -343,16 +357,13 @@ def main():
                 batch_size=args.batch_size, shuffle=False, num_workers=args.workers, pin_memory=True)
         
     else:
-        print "Unrecognized Dataset. Halt."
+        print("Unrecognized Dataset. Halt.")
         return 0
         
         
     # define loss function (criterion) and pptimizer
-    #criterion = nn.CrossEntropyLoss().cuda()
-    if 'L1' in args.arch or args.L1 == 1:
-        criterion = nn.L1Loss(size_average=True).cuda()
-    else:
-        criterion = nn.CrossEntropyLoss().cuda()
+    # Losses take integer labels and are built once, see losses.py
+    train_criterion, val_criterion = make_criterions()
 
         
     optimizer = torch.optim.SGD(model.parameters(), args.lr,
@@ -372,7 +383,7 @@ def main():
             # Reset Val_Loader!!
             val_loader = torch.utils.data.DataLoader(
                 datasets.ImageFolder(valdir, transforms.Compose([
-                    transforms.Scale((args.lastout+args.evalmodnum)*32),
+                    transforms.Resize((args.lastout+args.evalmodnum)*32),
                     transforms.RandomCrop((args.lastout+args.evalmodnum)*32),
                     transforms.RandomCrop(args.lastout*32),
                     transforms.RandomHorizontalFlip(),
@@ -394,10 +405,10 @@ def main():
 
         # train for one epoch
         for i in range(args.tl):
-            train(train_loader, model, criterion, optimizer, epoch)
+            train(train_loader, model, train_criterion, optimizer, epoch)
 
         # evaluate on validation set
-        prec1 = validate(val_loader, model, criterion)
+        prec1 = validate(val_loader, model, val_criterion)
 
         # remember best prec@1 and save checkpoint
         is_best = prec1 > best_prec1
@@ -408,8 +419,8 @@ def main():
             'state_dict': model.state_dict(),
             'best_prec1': best_prec1,
         }, is_best)
-        print 'Current best accuracy: ', best_prec1
-    print 'Global best accuracy: ', best_prec1
+        print('Current best accuracy: {}'.format(best_prec1))
+    print('Global best accuracy: {}'.format(best_prec1))
 
 
     
@@ -424,6 +435,52 @@ def current_labelsm(epoch, smlow = 0.01, smhi=0.99 , lpstart = 1.6, lpend = 4.0)
         return smlow  + (smhi-smlow) * (lpend*args.lp - epoch )/args.lp/(lpend-lpstart)
 
 
+def onehot_targets():
+    """The loss modes whose dense targets were one-hot, label smoothing is not applied under them"""
+    return 'L1' in args.arch or args.L1 == 1 or args.labelboost > 1e-6 or args.focal > 0
+
+
+def make_criterions():
+    """(train, validate) losses of the loss flags, first match of the order below wins"""
+    if 'L1' in args.arch or args.L1 == 1:
+        criterion = losses.ProbabilityL1Loss(args.nclass, softmax = False, huber = False, scale = 1.0)
+    else:
+        criterion = nn.CrossEntropyLoss()
+
+    # validate: L1, MarginP, labelboost
+    if args.L1:
+        val_criterion = losses.ProbabilityL1Loss(args.nclass)
+    elif args.MarginP > 0:
+        val_criterion = nn.MultiMarginLoss(p=args.MarginP, margin=args.MarginV)
+    elif abs(args.labelboost) > 1e-6:
+        val_criterion = losses.LabelBoostLoss(args.nclass, args.labelboost).eval()
+    else:
+        val_criterion = criterion
+
+    # train: labelsm (smooth set per epoch in train()), L1, MarginP, labelboost, focal
+    if args.labelsm:
+        train_criterion = losses.LabelSmoothingLoss(args.nclass)
+    elif args.L1 or args.MarginP > 0:
+        train_criterion = val_criterion
+    elif abs(args.labelboost) > 1e-6:
+        train_criterion = losses.LabelBoostLoss(args.nclass, args.labelboost)
+    elif args.focal > 0:
+        train_criterion = losses.FocalLoss(args.nclass)
+    else:
+        train_criterion = criterion
+    return train_criterion.cuda(), val_criterion.cuda()
+
+
+def encode_target(target, nclass, smooth = 1.0):
+    """
+    Dense targets from integer labels, built on target's device with one scatter:
+    one-hot for smooth = 1, else smooth on the label plus (1 - smooth)/nclass everywhere.
+    """
+    offvalue = (1.0 - smooth) / nclass
+    targetTensor = torch.full((target.size(0), nclass), offvalue, device=target.device)
+    return targetTensor.scatter_(1, target.view(-1, 1), smooth + offvalue)
+
+
 def train(train_loader, model, criterion, optimizer, epoch):
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -434,102 +491,29 @@ def train(train_loader, model, criterion, optimizer, epoch):
     # switch to train mode
     model.train()
 
+    # Label smoothing is fixed for the epoch. The L1 / labelboost / focal modes keep
+    # one-hot targets, so --labelsm with them trains plain cross entropy (smooth = 1)
+    if args.labelsm and not onehot_targets():
+        criterion.smooth = current_labelsm(epoch)
+
     end = time.time()
     for i, (input, target) in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
-        #print type(target.float())
-        if 'L1' in args.arch or args.L1==1 or args.labelboost>1e-6 or args.focal>0:
-            targetTensor = np.zeros((input.size()[0], args.nclass))
-            for j in range(input.size()[0]):
-                targetTensor[j, target[j]] = 1.0
-            #targetTensor = targetTensor[:input.size[0],:input.size[1]]
-            targetTensor = torch.FloatTensor(targetTensor)
-            targetTensor = targetTensor.cuda(async=True)
-            target = target.cuda(async=True)
-            target_var = torch.autograd.Variable(targetTensor)
+        target = target.cuda(non_blocking=True)
             
-        elif args.labelsm :
-            targetTensor = np.zeros((input.size()[0], args.nclass))
-            for j in range(input.size()[0]):
-                targetTensor[j, target[j]] = 1.0
-            targetTensor = (targetTensor*current_labelsm(epoch)+(1-current_labelsm(epoch))/args.nclass)
-            targetTensor = torch.FloatTensor(targetTensor)
-            targetTensor = targetTensor.cuda(async=True)
-            target = target.cuda(async=True)
-            target_var = torch.autograd.Variable(targetTensor)            
-        else:    
-            target = target.cuda(async=True)
-            target_var = torch.autograd.Variable(target)
-            
-        input_var = torch.autograd.Variable(input)
-        
+        if args.cl:
+            input = input.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        output = model(input_var)
-        
-        if args.labelsm:
-            #print input.size(), output.size(), target_var.size()
-            output = nn.LogSoftmax()(output)
-            #print output.data[0]
-            loss = torch.mean(torch.sum(torch.mul(-output,target_var) , 1))
-        elif args.L1:
-            output = nn.Softmax()(output)
-            loss = nn.SmoothL1Loss()(output*args.nclass,target_var*args.nclass)
-        elif args.MarginP > 0:
-            loss = nn.MultiMarginLoss(p=args.MarginP, margin=args.MarginV)(output, target_var)
-        elif abs(args.labelboost) > 1e-6:
-            # Boosted CNN Implementation
-            outq = nn.LogSoftmax()(output[:,:args.nclass])
-            outp = nn.Softmax()(output[:,:args.nclass])
-            #print "outp",(outp - outp[target]).data[0]
-            
-            # w = outp[target]#**(-1.0/args.nclass)
-            # w = outp[target]
-            #print outp.size(), target_var.size()
-            #print (outp * target_var).data[0]
-            w = (1.0/args.nclass +  torch.sum(outp * target_var ,1 )) ** (-1.0/args.labelboost)
-            w = w / torch.sum(w)
-            
-            #w = torch.exp(( - output + outp[target]) * (-0.5))
-            #print "w",w.data[0]
-            #print target_var.size(), (1 - torch.sum(w,1)).expand(input.size()[0], args.nclass).size()
-            # w1 = w + torch.mul(target_var , ( - torch.sum(w,1) ).expand(input.size()[0], args.nclass)  )
-            #print w1.data[0]
-            #print torch.sum( torch.mul( -outq , w ) , 1 ).size()
-            #print outq.size()
-            
-            #loss = torch.mean( torch.sum( torch.mul( -outq , (target_var + outp*args.labelboost)/(1.0 + args.labelboost) ) , 1 ))
-            #loss = torch.mean( torch.sum( w , 1 ) )
-            
-            loss = torch.sum(torch.mul(w , torch.sum(torch.mul(-outq, target_var),1)))
-        elif args.focal > 0:
-            
-            outq = nn.LogSoftmax()(output[:,:args.nclass])
-            outp = nn.Softmax()(output[:,:args.nclass])
-            OneMinusPToGamma = (1.0 - torch.sum(outp * target_var ,1 ))**2
-            LogP = torch.sum(- outq * target_var, 1)
-            loss = torch.mean(torch.mul(OneMinusPToGamma, LogP))
-            
-            
-            """
-            outp = nn.Softmax()(output)
-            #print outq.size(),outp.size(),target_var.size()
-            loss = torch.mean(\
-                              torch.sum(\
-                                torch.mul(-outq,  target_var * (1.0 + args.labelboost) - outp * (args.labelboost))
-                                        ,1)\
-                             )
-                             """
-        else:
-            loss = criterion(output, target_var)
-            
+        output = model(input)
+        loss = criterion(output, target)
 
         # measure accuracy and record loss
-        prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.data[0], input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        prec1, prec5 = accuracy(output.detach(), target, topk=(1, 5))
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -563,63 +547,21 @@ def validate(val_loader, model, criterion):
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
         
-        if 'L1' in args.arch or args.L1 == 1 or args.labelboost>1e-6:
-            targetTensor = np.zeros((input.size()[0], args.nclass))
-            for j in range(input.size()[0]):
-                targetTensor[j, target[j]] = 1.0
-            #targetTensor = targetTensor[:input.size[0],:input.size[1]]
-            targetTensor = torch.FloatTensor(targetTensor)
-            targetTensor = targetTensor.cuda(async=True)
-            target = target.cuda(async=True)
-            target_var = torch.autograd.Variable(targetTensor)
-        else:    
-            target = target.cuda(async=True)
-            target_var = torch.autograd.Variable(target, volatile=True)
-
+        target = target.cuda(non_blocking=True)
             
-        input_var = torch.autograd.Variable(input, volatile=True)
+        if args.cl:
+            input = input.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        output = model(input_var)
-        if args.L1:
-            output = nn.Softmax()(output)
-            loss = nn.SmoothL1Loss()(output*args.nclass,target_var*args.nclass)
-        elif args.MarginP > 0:
-            loss = nn.MultiMarginLoss(p=args.MarginP, margin=args.MarginV)(output, target_var)
-        
-        elif abs(args.labelboost) > 1e-6:
-            outq = nn.LogSoftmax()(output[:,:args.nclass])
-            outp = nn.Softmax()(output[:,:args.nclass])
-            #print "outp",(outp - outp[target]).data[0]
-            #w = torch.exp(( - output + outp[target]) * (-0.5))
-            #print "w",w.data[0]
-            #print target_var.size(), (1 - torch.sum(w,1)).expand(input.size()[0], args.nclass).size()
-            # w1 = w + torch.mul(target_var , ( - torch.sum(w,1) ).expand(input.size()[0], args.nclass)  )
-            #print w1.data[0]
-            #print torch.sum( torch.mul( -outq , w ) , 1 ).size()
-            
-            loss = torch.mean( torch.sum( torch.mul( -outq , (target_var + outp*args.labelboost)/(1.0 + args.labelboost) ) , 1 ))
-            #loss = torch.mean( torch.sum( w , 1 ) )
-            
-            
-            
-            """
-            outp = nn.Softmax()(output)
-            #print outq.size(),outp.size(),target_var.size()
-            loss = torch.mean(\
-                              torch.sum(\
-                                torch.mul(-outq,  target_var * (1.0 + args.labelboost) - outp * (args.labelboost))
-                                        ,1)\
-                             )
-                             """
-        else:
-            loss = criterion(output, target_var)
+        with torch.no_grad():
+            output = model(input)
+            loss = criterion(output, target)
 
         # measure accuracy and record loss
-        prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.data[0], input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        prec1, prec5 = accuracy(output, target, topk=(1, 5))
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -636,6 +578,7 @@ def validate(val_loader, model, criterion):
 
     print(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
           .format(top1=top1, top5=top5))
+    print_fast_path_stats(model)
 
     return top1.avg
 
@@ -652,28 +595,29 @@ def test_output(val_loader, model, output_name):
     for i, (input, target) in enumerate(val_loader):
         #if i>5:
         #    break
-        if 'L1' in args.arch or args.L1 == 1:
-            tmp = np.zeros((input.size()[0], args.nclass))
-            for j in range(input.size()[0]):
-                tmp[j, target[j]] = 1.0
-            
-            # tmp and input ???
-            target = torch.FloatTensor(tmp)
-            target = target.cuda(async=True)
-        else:    
-            target = target.cuda(async=True)
-            
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target, volatile=True)
+        if args.cl:
+            input = input.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        output = model(input_var)
-        output = output.data.cpu().numpy()
-        print i, output.shape
+        with torch.no_grad():
+            output = model(input)
+        output = output.cpu().numpy()
+        print('{} {}'.format(i, output.shape))
         finalres.append(pd.DataFrame(output))
     
     pd.concat(finalres,axis=0).to_hdf(output_name+'.hdf','result')
-    print 'Finished Writing to HDF5 File.'
+    print('Finished Writing to HDF5 File.')
+    print_fast_path_stats(model)
+
+
+def print_fast_path_stats(model):
+    """Prints how often each ConvOffset2D skipped sampling, see --fpt"""
+    if args.fpt <= 0:
+        return
+    stats = offset_fast_path_stats(model)
+    for name in sorted(stats.keys()):
+        print('Fast Path {0}: calls {1[calls]} skipped {1[skipped_call_rate]:.3f} '
+              'tiles {1[tiles]} skipped {1[skipped_tile_rate]:.3f}'.format(name, stats[name]))
 
 
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
@@ -734,7 +678,7 @@ def accuracy(output, target, topk=(1,)):
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0)
+        correct_k = correct[:k].reshape(-1).float().sum(0)
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
@@ -5,6 +5,8 @@ import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+
+import fractal
 #import torch.utils.model_zoo as model_zoo
 
 
@@ -12,6 +14,44 @@ __all__ = ['fractallnext', 'fanext50', 'fanext101',
            'fanext152']
 
 
+def _branch_order(group_planlist, groups):
+    '''
+    Channel order of a packed grouped conv2: entry n is the index packed channel n had in
+    torch.cat of the per-branch convs. The per-branch outputs are branch-major (all groups
+    of branch 0, then branch 1 ...), the packed conv output is group-major (all branches of
+    group 0, then group 1 ...), as a grouped conv needs.
+    '''
+    order = []
+    for g in range(groups):
+        offset = 0
+        for val in group_planlist:
+            order.extend(offset + g * val + p for p in range(val))
+            offset += val * groups
+    return order
+
+
+def _branch_std(vals, fanout, kernel_size):
+    '''He init std of every output channel of a packed conv, from the fan-out of its own branch'''
+    return torch.Tensor([math.sqrt(2. / (kernel_size * kernel_size * fanout(val)))
+                         for val in vals for _ in range(val)])
+
+
+def _pop_legacy(state_dict, names, order=None):
+    '''torch.cat of legacy per-branch tensors, reordered to the packed channel order'''
+    packed = torch.cat([state_dict.pop(name) for name in names])
+    return packed if order is None else packed[torch.LongTensor(order)]
+
+
+def _permute_bn2_conv3(state_dict, prefix, order):
+    '''bn2 channels and conv3 input channels of a legacy checkpoint, in the packed order'''
+    order = torch.LongTensor(order)
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        if prefix + 'bn2.' + name in state_dict:
+            state_dict[prefix + 'bn2.' + name] = state_dict[prefix + 'bn2.' + name][order]
+    if prefix + 'conv3.weight' in state_dict:
+        state_dict[prefix + 'conv3.weight'] = state_dict[prefix + 'conv3.weight'][:, order]
+
+
 class FANeXtBottleneck(nn.Module):
     expansion = 2
     def __init__(self, inplanes, planes, stride=1, downsample=None):
@@ -38,19 +78,10 @@ class FANeXtBottleneck(nn.Module):
         
         self.conv1 = nn.Conv2d(inplanes,planes,kernel_size=1,bias=False)
         self.bn1 = nn.BatchNorm2d(planes)
-        for idx,planval in enumerate(self.group_plan):
-            #exec('self.conv1_{idx}=nn.Conv2d(inplanes, {val}, kernel_size=1, bias=False)'.format(idx=idx,val=planval))
-            #exec('self.bn1_{idx}=nn.BatchNorm2d({val})'.format(idx=idx,val=planval))
-            #exec('self.conv2_{idx}=nn.Conv2d({val}, {val}, kernel_size=3,stride=stride,padding=1,bias=False)'\
-            #     .format(idx=idx,val=planval))
-            exec('self.conv2_{idx}=nn.Conv2d(planes, {val}, kernel_size=3, stride=stride, padding=1, bias=False)'\
-                 .format(idx=idx,val=planval))
-            
-            #exec('self.bn2_{idx}=nn.BatchNorm2d({val})'.format(idx=idx,val=planval))
-            #exec('self.conv3_{idx}=nn.Conv2d({val}, planes*2, kernel_size=1, bias=False)'.format(idx=idx,val=planval))
-        
-        #self.conv2_0 = nn.Conv2d(planes, planes/2, kernel_size=3,stride=stride,padding=1,bias=False)
-        #self.conv2_1 = nn.Conv2d(planes, planes/2, kernel_size=3,stride=stride,padding=1,bias=False)
+        # All 32 branches read the full input: packed into one wide conv whose output
+        # channels are the torch.cat of the former conv2_{idx} branches, in group_plan order
+        self.conv2 = nn.Conv2d(planes, sum(self.group_plan), kernel_size=3, stride=stride, padding=1, bias=False)
+        self._register_load_state_dict_pre_hook(self._pack_legacy_branches)
         
         self.bn2 = nn.BatchNorm2d(planes)
         self.conv3 = nn.Conv2d(planes, planes * 2, kernel_size=1, bias=False)
@@ -60,6 +91,16 @@ class FANeXtBottleneck(nn.Module):
         self.downsample = downsample
         self.stride = stride
         
+    def reset_branches(self):
+        # He init per branch, as for the separate conv2_{idx}
+        std = _branch_std(self.group_plan, lambda val: val, 3)
+        self.conv2.weight.data.normal_(0, 1).mul_(std.view(-1, 1, 1, 1))
+
+    def _pack_legacy_branches(self, state_dict, prefix, *args):
+        legacy = [prefix + 'conv2_{0}.weight'.format(idx) for idx in range(len(self.group_plan))]
+        if all(name in state_dict for name in legacy):
+            state_dict[prefix + 'conv2.weight'] = _pop_legacy(state_dict, legacy)
+
     def forward(self, x):    
         residual = x
         if self.downsample is not None:
@@ -90,8 +131,7 @@ class FANeXtBottleneck(nn.Module):
         out = self.bn1(out)
         out = self.relu(out)
         
-        s = ','.join(['self.conv2_{idx}(out)'.format(idx=i) for i in range(32)])
-        exec('out = torch.cat([{s}],1)'.format(s=s))
+        out = self.conv2(out)
         
         
         out = self.bn2(out)
@@ -154,19 +194,11 @@ class FANeXtBottleneckV2(nn.Module):
         
         self.conv1 = nn.Conv2d(inplanes,planes,kernel_size=1,bias=False)
         self.bn1 = nn.BatchNorm2d(planes)
-        for idx,planval in enumerate(self.group_planlist):
-            #exec('self.conv1_{idx}=nn.Conv2d(inplanes, {val}, kernel_size=1, bias=False)'.format(idx=idx,val=planval))
-            #exec('self.bn1_{idx}=nn.BatchNorm2d({val})'.format(idx=idx,val=planval))
-            #exec('self.conv2_{idx}=nn.Conv2d({val}, {val}, kernel_size=3,stride=stride,padding=1,bias=False)'\
-            #     .format(idx=idx,val=planval))
-            exec('self.conv2_{idx}=nn.Conv2d(planes, {val}, kernel_size=3, groups={groups}, stride=stride, padding=1, bias=False)'\
-                 .format(idx=idx,val=planval*self.groups,groups=self.groups))
-            
-            #exec('self.bn2_{idx}=nn.BatchNorm2d({val})'.format(idx=idx,val=planval))
-            #exec('self.conv3_{idx}=nn.Conv2d({val}, planes*2, kernel_size=1, bias=False)'.format(idx=idx,val=planval))
-        
-        #self.conv2_0 = nn.Conv2d(planes, planes/2, kernel_size=3,stride=stride,padding=1,bias=False)
-        #self.conv2_1 = nn.Conv2d(planes, planes/2, kernel_size=3,stride=stride,padding=1,bias=False)
+        # The 4 branches are grouped convs over the same 8 input groups: packed into one
+        # grouped conv, each group outputs its slice of every branch (see _branch_order)
+        self.branch_order = _branch_order(self.group_planlist, self.groups)
+        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, groups=self.groups, stride=stride, padding=1, bias=False)
+        self._register_load_state_dict_pre_hook(self._pack_legacy_branches)
         
         self.bn2 = nn.BatchNorm2d(planes)
         self.conv3 = nn.Conv2d(planes, planes * 2, kernel_size=1, bias=False)
@@ -176,6 +208,17 @@ class FANeXtBottleneckV2(nn.Module):
         self.downsample = downsample
         self.stride = stride
         
+    def reset_branches(self):
+        # He init per branch, as for the separate conv2_{idx}
+        std = _branch_std(self.group_planlist * self.groups, lambda val: val * self.groups, 3)
+        self.conv2.weight.data.normal_(0, 1).mul_(std.view(-1, 1, 1, 1))
+
+    def _pack_legacy_branches(self, state_dict, prefix, *args):
+        legacy = [prefix + 'conv2_{0}.weight'.format(idx) for idx in range(len(self.group_planlist))]
+        if all(name in state_dict for name in legacy):
+            state_dict[prefix + 'conv2.weight'] = _pop_legacy(state_dict, legacy, self.branch_order)
+            _permute_bn2_conv3(state_dict, prefix, self.branch_order)
+
     def forward(self, x):    
         residual = x
         if self.downsample is not None:
@@ -206,8 +249,7 @@ class FANeXtBottleneckV2(nn.Module):
         out = self.bn1(out)
         out = self.relu(out)
         
-        s = ','.join(['self.conv2_{idx}(out)'.format(idx=i) for i in range(4)])
-        exec('out = torch.cat([{s}],1)'.format(s=s))
+        out = self.conv2(out)
         
         
         out = self.bn2(out)
@@ -268,22 +310,17 @@ class FANeXtBottleneckV3(nn.Module):
         '''
         
         
-        #self.conv1 = nn.Conv2d(inplanes,planes,kernel_size=1,bias=False)
-        #self.bn1 = nn.BatchNorm2d(planes)
-        for idx,planval in enumerate(self.group_planlist):
-            exec('self.conv1_{idx}=nn.Conv2d(inplanes, {val}, kernel_size=1, bias=False)'.\
-                 format(idx=idx,val=planval*self.groups))
-            exec('self.bn1_{idx}=nn.BatchNorm2d({val})'.format(idx=idx,val=planval*self.groups))
-            #exec('self.conv2_{idx}=nn.Conv2d({val}, {val}, kernel_size=3,stride=stride,padding=1,bias=False)'\
-            #     .format(idx=idx,val=planval))
-            exec('self.conv2_{idx}=nn.Conv2d({val}, {val}, kernel_size=3, groups={groups}, stride=stride, padding=1, bias=False)'\
-                 .format(idx=idx,val=planval*self.groups,groups=self.groups))
-            
-            #exec('self.bn2_{idx}=nn.BatchNorm2d({val})'.format(idx=idx,val=planval))
-            #exec('self.conv3_{idx}=nn.Conv2d({val}, planes*2, kernel_size=1, bias=False)'.format(idx=idx,val=planval))
-        
-        #self.conv2_0 = nn.Conv2d(planes, planes/2, kernel_size=3,stride=stride,padding=1,bias=False)
-        #self.conv2_1 = nn.Conv2d(planes, planes/2, kernel_size=3,stride=stride,padding=1,bias=False)
+        # conv1_{idx}/bn1_{idx} of the 4 branches are packed into one wide conv1/bn1, channels in
+        # the torch.cat order of the branches. Consecutive branches of the same width are one
+        # grouped conv2 run (8 groups per branch), so conv2 holds only the branch weights.
+        self.conv2_runs = self._make_runs(self.group_planlist, self.groups)
+        self.conv1 = nn.Conv2d(inplanes, planes, kernel_size=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(planes)
+        self.conv2 = nn.ModuleList([
+            nn.Conv2d(end - start, end - start, kernel_size=3, groups=(end - start) // val, stride=stride,
+                      padding=1, bias=False)
+            for val, start, end, _ in self.conv2_runs])
+        self._register_load_state_dict_pre_hook(self._pack_legacy_branches)
         
         self.bn2 = nn.BatchNorm2d(planes)
         self.conv3 = nn.Conv2d(planes, planes * 2, kernel_size=1, bias=False)
@@ -293,6 +330,44 @@ class FANeXtBottleneckV3(nn.Module):
         self.downsample = downsample
         self.stride = stride
         
+    @staticmethod
+    def _make_runs(group_planlist, groups):
+        '''(width, first channel, end channel, branches) of every run of equal-width branches'''
+        runs = []
+        start = 0
+        for idx, val in enumerate(group_planlist):
+            end = start + val * groups
+            if runs and runs[-1][0] == val:
+                runs[-1] = (val, runs[-1][1], end, runs[-1][3] + [idx])
+            else:
+                runs.append((val, start, end, [idx]))
+            start = end
+        return runs
+
+    def reset_branches(self):
+        # He init per branch, as for the separate conv1_{idx}/conv2_{idx}
+        vals = [val * self.groups for val in self.group_planlist]
+        self.conv1.weight.data.normal_(0, 1).mul_(_branch_std(vals, lambda val: val, 1).view(-1, 1, 1, 1))
+        for (val, _, _, _), conv in zip(self.conv2_runs, self.conv2):
+            conv.weight.data.normal_(0, math.sqrt(2. / (9 * val * self.groups)))
+
+    def _pack_legacy_branches(self, state_dict, prefix, *args):
+        branches = range(len(self.group_planlist))
+        legacy = [prefix + 'conv2_{0}.weight'.format(idx) for idx in branches]
+        if not all(name in state_dict for name in legacy):
+            return
+        state_dict[prefix + 'conv1.weight'] = _pop_legacy(
+            state_dict, [prefix + 'conv1_{0}.weight'.format(idx) for idx in branches])
+        for name in ['weight', 'bias', 'running_mean', 'running_var']:
+            state_dict[prefix + 'bn1.' + name] = _pop_legacy(
+                state_dict, [prefix + 'bn1_{0}.{1}'.format(idx, name) for idx in branches])
+        tracked = [prefix + 'bn1_{0}.num_batches_tracked'.format(idx) for idx in branches]
+        if all(name in state_dict for name in tracked):
+            state_dict[prefix + 'bn1.num_batches_tracked'] = [state_dict.pop(name) for name in tracked][0]
+        for run, (_, _, _, run_branches) in enumerate(self.conv2_runs):
+            state_dict[prefix + 'conv2.{0}.weight'.format(run)] = _pop_legacy(
+                state_dict, [legacy[idx] for idx in run_branches])
+
     def forward(self, x):    
         residual = x
         if self.downsample is not None:
@@ -319,12 +394,11 @@ class FANeXtBottleneckV3(nn.Module):
         '''
         
         # ResistOOM
-        #out = self.conv1(x)
-        #out = self.bn1(out)
-        #out = self.relu(out)
+        out = self.conv1(x)
+        out = self.bn1(out)
+        out = self.relu(out)
         
-        s = ','.join(['self.conv2_{idx}(self.relu(self.bn1_{idx}(self.conv1_{idx}(x))))'.format(idx=i) for i in range(4)])
-        exec('out = torch.cat([{s}],1)'.format(s=s))
+        out = torch.cat([conv(out[:, start:end]) for (_, start, end, _), conv in zip(self.conv2_runs, self.conv2)], 1)
         
         
         out = self.bn2(out)
@@ -361,29 +435,27 @@ class FANeXtBottleneckV3(nn.Module):
         return out
         '''
         
-class FABigBlock(nn.Module):
-    fracparam = 2
-    def __init__():
-        super(FAResNeXt, self).__init__()
-    def _make_layer():
-        layers = []
-        #Ordinary, Make N Layer
-        self.layers = layers
-        return nn.Sequential(*layers)
-    def forward(x):
-        exec('level_0 = x')
-        for i in range(len(self.layers)):
-            idx = i+1
-            exec('level_{idx} = self.layers[i](level_{i})'.format(idx=idx,i=i))
-            '''
-            tmp = block(self.inplanes, planes)
-            tmpdist = self.fracparam
-            while tmpdist <= len(layers):
-                tmp = tmp + layers[-tmpdist]
-                tmpdist *= self.fracparam
-            layers.append(tmp)
-            '''
-        
+class FABigBlock(nn.Sequential):
+    '''
+    Block group with vertical fractal skips: block idx reads the output of block idx-1 and
+    adds the outputs of blocks idx - fracparam**k, k >= 1, while >= 0. Same children as the
+    nn.Sequential of _make_nonfractal_layer, so the state_dict keys are the same.
+    '''
+    def __init__(self, layers, fracparam=2):
+        super(FABigBlock, self).__init__(*layers)
+        self.fracparam = fracparam
+        self.plan = fractal.make_plan(len(layers), fracparam)
+
+    def max_live(self):
+        '''Most block outputs held at once by forward, the group input and result included'''
+        return fractal.max_live(self.plan)
+
+    def forward(self, x):
+        # The dict owns the group input, so it is freed after its last use
+        outs = {-1: x}
+        x = None
+        return fractal.run_plan(self, self.plan, outs).pop(len(self.plan) - 1)
+
 
         
 class FAResNeXt(nn.Module):
@@ -417,6 +489,9 @@ class FAResNeXt(nn.Module):
             elif isinstance(m, nn.BatchNorm2d):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
+        for m in self.modules():
+            if isinstance(m, (FANeXtBottleneck, FANeXtBottleneckV2, FANeXtBottleneckV3)):
+                m.reset_branches()
                 
     def _make_nonfractal_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -437,26 +512,7 @@ class FAResNeXt(nn.Module):
         return nn.Sequential(*layers)
     
     def _make_fractal_layer(self, block, planes, blocks, stride=1):
-        downsample = None
-        if stride != 1 or self.inplanes != planes * block.expansion:
-            downsample = nn.Sequential(
-                nn.Conv2d(self.inplanes, planes * block.expansion,
-                          kernel_size=1, stride=stride, bias=False),
-                nn.BatchNorm2d(planes * block.expansion),
-            )
-            
-        layers = []
-        layers.append(block(self.inplanes, planes, stride, downsample))
-        self.inplanes = planes * block.expansion
-        for i in range(1, blocks):
-            tmp = block(self.inplanes, planes)
-            tmpdist = self.fracparam
-            while tmpdist <= len(layers):
-                tmp = tmp + layers[-tmpdist]
-                tmpdist *= self.fracparam
-            layers.append(tmp)
-            
-        return nn.Sequential(*layers)
+        return FABigBlock(self._make_nonfractal_layer(block, planes, blocks, stride), self.fracparam)
     
     def forward(self, x):
         x = self.conv1(x)
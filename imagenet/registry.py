@@ -0,0 +1,250 @@
+"""Architecture registry of the resnext.py and meta_model/FractAllNeXt.py factories
+
+Every factory is listed by name with the module it lives in, which is only
+imported when a model of that family is built or profiled, so importing the
+registry is cheap. build() filters the arguments down to what the factory
+(and the class it forwards **kwargs to) accepts, so one argument set, e.g.
+main_next.py's, serves every family.
+
+profile() returns the parameter count, FLOPs and activation memory of a
+configuration. The model is built and run on the meta device, so no weights
+or activations are allocated, and the result is cached on disk keyed by the
+full factory arguments (defaults included) and the input size:
+
+    import registry
+    registry.profile('resnext_imagenet1k', numlayers=50, x=32, d=4, sqex=1)
+    {'params': ..., 'flops': ..., 'activation_bytes': ..., 'input_size': 224}
+
+Sweep from the command line (from imagenet/):
+    python registry.py --arch resnext_imagenet1k --set x=16,32,64 --set d=4,8
+    python registry.py --arch faresnext50,faresnext50v2,faresnext50v3
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+try:
+    from torch.utils.flop_counter import FlopCounterMode
+except ImportError:
+    FlopCounterMode = None
+
+
+# Bump when model code changes what a cached profile would measure
+PROFILE_VERSION = 3
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'resnext', 'profiles.json')
+
+# name: (module, factory, class the factory forwards **kwargs to)
+ARCHS = {
+    'resnet18': ('resnext', 'resnet18', 'ResNet'),
+    'resnet34': ('resnext', 'resnet34', 'ResNet'),
+    'resnet50': ('resnext', 'resnet50', 'ResNet'),
+    'resnet101': ('resnext', 'resnet101', 'ResNet'),
+    'resnet152': ('resnext', 'resnet152', 'ResNet'),
+    'resnext26': ('resnext', 'resnext26', 'ResNeXt'),
+    'resnext38': ('resnext', 'resnext38', 'ResNeXt'),
+    'resnext50': ('resnext', 'resnext50', 'ResNeXt'),
+    'resnext101': ('resnext', 'resnext101', 'ResNeXt'),
+    'resnext152': ('resnext', 'resnext152', 'ResNeXt'),
+    'resnext50my': ('resnext', 'resnext50my', 'ResNeXt'),
+    'resnext50myL1': ('resnext', 'resnext50myL1', 'ResNeXt'),
+    'resnext50L1': ('resnext', 'resnext50L1', 'ResNeXt'),
+    'resnext50v': ('resnext', 'resnext50v', 'ResNeXt'),
+    'resnext50hgs': ('resnext', 'resnext50hgs', 'ResNeXt_HGS'),
+    'resnext50x2': ('resnext', 'resnext50x2', 'ResNeXt'),
+    'resnext29_cifar10': ('resnext', 'resnext29_cifar10', 'ResNeXt'),
+    'resnext_cifar100': ('resnext', 'resnext_cifar100', 'ResNeXt'),
+    'resnext29_cifar100': ('resnext', 'resnext29_cifar100', 'ResNeXt'),
+    'irnext29_cifar100': ('resnext', 'irnext29_cifar100', 'ResNeXt'),
+    'irnext20_cifar100': ('resnext', 'irnext20_cifar100', 'ResNeXt'),
+    'resnext_imagenet1k': ('resnext', 'resnext_imagenet1k', 'ResNeXt'),
+    'resnext38_imagenet1k': ('resnext', 'resnext38_imagenet1k', 'ResNeXt'),
+    'resnext50_imagenet1k': ('resnext', 'resnext50_imagenet1k', 'ResNeXt'),
+    'resnext_inaturalist': ('resnext', 'resnext_inaturalist', 'ResNeXt'),
+    'resnext38_inaturalist': ('resnext', 'resnext38_inaturalist', 'ResNeXt'),
+    'resnext50_inaturalist': ('resnext', 'resnext50_inaturalist', 'ResNeXt'),
+    'resnext50_cub200': ('resnext', 'resnext50_cub200', 'ResNeXt'),
+    'Res_Deeplab': ('resnext', 'Res_Deeplab', 'ResNeXt'),
+    'faresnext50': ('meta_model.FractAllNeXt', 'faresnext50', 'FAResNeXt'),
+    'faresnext50v2': ('meta_model.FractAllNeXt', 'faresnext50v2', 'FAResNeXt'),
+    'faresnext50v3': ('meta_model.FractAllNeXt', 'faresnext50v3', 'FAResNeXt'),
+    'faresnext101': ('meta_model.FractAllNeXt', 'faresnext101', 'FAResNeXt'),
+    'faresnext101v2': ('meta_model.FractAllNeXt', 'faresnext101v2', 'FAResNeXt'),
+    'faresnext101v3': ('meta_model.FractAllNeXt', 'faresnext101v3', 'FAResNeXt'),
+    'faresnext152': ('meta_model.FractAllNeXt', 'faresnext152', 'FAResNeXt'),
+}
+
+_profiles = {}
+
+
+def arch_names():
+    return sorted(ARCHS)
+
+
+def _argspec(fn):
+    """(argument names, {name: default}, takes **kwargs) of a function or class"""
+    if inspect.isclass(fn):
+        fn = fn.__init__
+    getspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+    spec = getspec(fn)
+    names = [name for name in spec[0] if name != 'self']
+    defaults = spec[3] or ()
+    return names, dict(zip(spec[0][len(spec[0]) - len(defaults):], defaults)), spec[2] is not None
+
+
+def get_factory(arch):
+    """The factory function of arch, its module is imported on first use"""
+    if arch not in ARCHS:
+        raise ValueError('Unknown architecture: {0}, choose from {1}'.format(arch, ', '.join(arch_names())))
+    module, factory, _ = ARCHS[arch]
+    return getattr(importlib.import_module(module), factory)
+
+
+def factory_kwargs(arch, **kwargs):
+    """kwargs restricted to what the factory of arch accepts, factory defaults filled in"""
+    module, factory, target = ARCHS[arch]
+    names, defaults, varkw = _argspec(get_factory(arch))
+    accepted = set(names)
+    target = getattr(importlib.import_module(module), target, None)
+    if varkw and target is not None:
+        names, _, varkw = _argspec(target)
+        accepted.update(names[2:])
+    resolved = dict(defaults)
+    resolved.update((k, v) for k, v in kwargs.items() if varkw or k in accepted)
+    return resolved
+
+
+def build(arch, **kwargs):
+    """Constructs arch from the arguments its factory accepts, the others are ignored"""
+    return get_factory(arch)(**factory_kwargs(arch, **kwargs))
+
+
+def _input_size(arch, kwargs):
+    # Every family ends on a lastout x lastout map after a /32 stride, CIFAR on /4
+    lastout = kwargs.get('lastout', 7)
+    if 'cifar' in arch:
+        return lastout * 4
+    if 'Deeplab' in arch:
+        return 321
+    return lastout * 32
+
+
+def _measure(arch, kwargs, input_size):
+    leaves = []
+
+    def count_output(module, input, output):
+        for out in (output if isinstance(output, (list, tuple)) else [output]):
+            if torch.is_tensor(out):
+                leaves.append(out.numel() * out.element_size())
+
+    with torch.device('meta'):
+        model = get_factory(arch)(**kwargs)
+        x = torch.empty(1, 3, input_size, input_size)
+    model.eval()
+    params = sum(p.numel() for p in model.parameters())
+    handles = [m.register_forward_hook(count_output) for m in model.modules()
+               if not list(m.children()) and not isinstance(m, (nn.ReLU, nn.Dropout))]
+    flops = None
+    with torch.no_grad():
+        if FlopCounterMode is not None:
+            counter = FlopCounterMode(display=False)
+            with counter:
+                model(x)
+            flops = counter.get_total_flops()
+        else:
+            model(x)
+    for handle in handles:
+        handle.remove()
+    return {'params': int(params), 'flops': flops, 'activation_bytes': int(sum(leaves)),
+            'input_size': input_size}
+
+
+def _load_cache(path):
+    if path not in _profiles:
+        _profiles[path] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                _profiles[path] = json.load(f)
+    return _profiles[path]
+
+
+def _save_cache(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(_profiles[path], f, sort_keys=True, indent=0)
+    os.rename(tmp, path)
+
+
+def profile(arch, input_size=None, cache=DEFAULT_CACHE, **kwargs):
+    """
+    {'params', 'flops', 'activation_bytes', 'input_size'} of arch built with kwargs,
+    for one image of input_size (default: from lastout). FLOPs count a multiply-add
+    as 2, activation_bytes sums the outputs of the leaf modules in eval mode. Cached
+    in the JSON file cache (None: in memory only).
+    """
+    kwargs = factory_kwargs(arch, **kwargs)
+    kwargs.pop('pretrained', None)
+    if input_size is None:
+        input_size = _input_size(arch, kwargs)
+    key = json.dumps([PROFILE_VERSION, arch, input_size, kwargs], sort_keys=True)
+
+    profiles = _load_cache(cache) if cache else _profiles.setdefault(None, {})
+    if key not in profiles:
+        profiles[key] = _measure(arch, kwargs, input_size)
+        if cache:
+            _save_cache(cache)
+    return profiles[key]
+
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parameter / FLOP / activation profile sweep')
+    parser.add_argument('--arch', default='resnext_imagenet1k', type=str,
+                        help='comma separated architectures, "all" for every registered one')
+    parser.add_argument('--set', default=[], action='append', metavar='NAME=V1,V2',
+                        help='factory argument and the values to sweep, repeatable')
+    parser.add_argument('--size', default=None, type=int, help='input height and width')
+    parser.add_argument('--cache', default=DEFAULT_CACHE, type=str, help='profile cache, "" to disable')
+    args = parser.parse_args()
+
+    archs = arch_names() if args.arch == 'all' else args.arch.split(',')
+    names, values = [], []
+    for item in args.set:
+        name, vals = item.split('=', 1)
+        names.append(name)
+        values.append([_parse_value(v) for v in vals.split(',')])
+
+    for arch in archs:
+        for combo in itertools.product(*values):
+            config = dict(zip(names, combo))
+            try:
+                p = profile(arch, args.size, args.cache or None, **config)
+            except Exception as e:
+                print('{0:24s} {1} failed: {2}'.format(arch, config, e))
+                continue
+            flops = '{0:8.3f} GFLOPs'.format(p['flops'] / 1e9) if p['flops'] is not None else '     n/a'
+            print('{0:24s} {1} {2:9.3f} M params {3} {4:8.1f} MB activations @{5}'.format(
+                arch, config, p['params'] / 1e6, flops, p['activation_bytes'] / 2. ** 20, p['input_size']))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,14 @@ import torch
 import torch.nn as nn
 import math
 import copy
+import functools
 import numpy as np
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
 #import torch.utils.model_zoo as model_zoo
 
 # Directly Import Deformable Conv Nets
-from torch_deform_conv.layers import ConvOffset2D
+from torch_deform_conv.layers import ConvOffset2D, DeformConv2d
+import fractal
 
 
 
@@ -107,11 +110,52 @@ class Bottleneck(nn.Module):
 
         return out
 
+def _se_ratt_gate(out, se, ratt):
+    return out * se * ratt
+
+try:
+    # One Elementwise Kernel Where A TorchScript Fuser Is Available
+    _se_ratt_gate = torch.jit.script(_se_ratt_gate)
+except Exception:
+    pass
+
+
+class SqueezeExcitation(nn.Module):
+    '''
+    Squeeze-Excitation channel gate, with ratt the simple Residual Attention spatial gate on top.
+    Pooling is adaptive, so the gate works at any input resolution. reduction shrinks the
+    hidden width of both gates, 1 is the full width of the original blocks.
+    Both gates are applied to the input in one pass, in place when no grad is needed.
+    '''
+    def __init__(self, channels, reduction = 1, ratt = 0):
+        super(SqueezeExcitation, self).__init__()
+        self.channels = channels
+        self.ratt = ratt
+        hidden = max(int(channels // reduction), 1)
+        self.fc31 = nn.Linear(channels, hidden)
+        self.fc32 = nn.Linear(hidden, channels)
+        if self.ratt:
+            self.conv41 = nn.Conv2d(channels, hidden, kernel_size=1, groups=1, bias=False)
+            self.conv42 = nn.Conv2d(hidden, 1, kernel_size=1, groups=1, bias=False)
+
+    def forward(self, out):
+        out_sqex = nn.functional.adaptive_avg_pool2d(out, 1).view(out.size(0), -1)
+        out_sqex = torch.sigmoid(self.fc32(self.fc31(out_sqex))).view(-1, self.channels, 1, 1)
+        if not self.ratt:
+            return out.mul_(out_sqex) if not torch.is_grad_enabled() else out * out_sqex
+
+        out_ratt = torch.sigmoid(self.conv42(self.conv41(out)))
+        if not torch.is_grad_enabled():
+            return out.mul_(out_sqex).mul_(out_ratt)
+        return _se_ratt_gate(out, out_sqex, out_ratt)
+
+
 class NeXtBottleneck(nn.Module):
     # expansion = 2
 
     def __init__(self, inplanes, planes, stride=1, downsample=None, finer = 1, upgroup=False, downgroup=False, \
-                 expansion = 2, secord = False, soadd = 0.01, dil = 1, deform = 0, sqex = 0, mapsize = None, ratt=0):
+                 expansion = 2, secord = False, soadd = 0.01, dil = 1, deform = 0, sqex = 0, mapsize = None, ratt=0, \
+                 offset_groups = None, fusedeform = 0, sereduce = 1):
         super(NeXtBottleneck, self).__init__()
         self.secord = secord
         self.soadd = soadd
@@ -120,10 +164,13 @@ class NeXtBottleneck(nn.Module):
         self.deform = deform
         self.sqex = sqex
         self.ratt = ratt
+        # Fused Deformable: conv2 Samples Its Own Kernel Taps, No offset2
+        self.fusedeform = fusedeform if deform > 0 else 0
         
-        # Deformable Plugin
-        if self.deform>0:
-            self.offset2 = ConvOffset2D(planes)
+        # Deformable Plugin, offset_groups: 0 -> One Offset Field Per Channel, N -> N Shared Fields,
+        # None -> Layer Default (One Per Channel For ConvOffset2D, One Shared For DeformConv2d)
+        if self.deform>0 and not self.fusedeform:
+            self.offset2 = ConvOffset2D(planes, offset_groups = offset_groups)
         else:
             pass
         
@@ -136,7 +183,11 @@ class NeXtBottleneck(nn.Module):
         # Trunk Branch
         self.conv1 = nn.Conv2d(inplanes, planes, kernel_size=1, groups=int(32 * finer) if upgroup else 1, bias=False)
         self.bn1 = nn.BatchNorm2d(planes)
-        self.conv2 = nn.Conv2d(planes, deformable_planes, kernel_size=3, groups=int(32 * finer), stride=stride,
+        if self.fusedeform:
+            self.conv2 = DeformConv2d(planes, deformable_planes, kernel_size=3, groups=int(32 * finer), stride=stride,
+                               padding=dil, dilation=dil, bias=False, offset_groups=offset_groups)
+        else:
+            self.conv2 = nn.Conv2d(planes, deformable_planes, kernel_size=3, groups=int(32 * finer), stride=stride,
                                padding=dil, dilation=dil, bias=False)
         self.bn2 = nn.BatchNorm2d(deformable_planes)
         self.conv3 = nn.Conv2d(deformable_planes, int(planes * expansion), kernel_size=1, groups=int(32 * finer) if downgroup else 1, bias=False)
@@ -144,14 +195,11 @@ class NeXtBottleneck(nn.Module):
         self.bn3 = nn.BatchNorm2d( int(planes * expansion) )
         
         
+        # Squeeze Excitation (+ Residual Attention), mapsize Is No Longer Needed
         if self.sqex > 0:
-            self.pool3 = nn.AvgPool2d(mapsize, stride=None, padding=0, ceil_mode=False, count_include_pad=True)
-            self.fc31 = nn.Linear(int(planes*expansion), int(planes*expansion))
-            self.fc32 = nn.Linear(int(planes*expansion), int(planes*expansion))
-            self.sigmoid = nn.Sigmoid()
-            
-            self.conv41 = nn.Conv2d(int(planes * expansion),int(planes * expansion), kernel_size=1, groups=1, bias=False)
-            self.conv42 = nn.Conv2d(int(planes * expansion), 1, kernel_size=1, groups=1, bias=False)
+            self.segate = SqueezeExcitation(int(planes * expansion), reduction = sereduce, ratt = ratt)
+            # Checkpoints With fc31/fc32/conv41/conv42 On The Block Still Load
+            self._register_load_state_dict_pre_hook(self._move_sqex_params)
             
 
         # Side(Attention Branch)
@@ -170,6 +218,11 @@ class NeXtBottleneck(nn.Module):
         self.downsample = downsample
         self.stride = stride
 
+    def _move_sqex_params(self, state_dict, prefix, *args):
+        for name in ['fc31.weight', 'fc31.bias', 'fc32.weight', 'fc32.bias', 'conv41.weight', 'conv42.weight']:
+            if prefix + name in state_dict:
+                state_dict[prefix + 'segate.' + name] = state_dict.pop(prefix + name)
+
     def forward(self, x):
         residual = x
 
@@ -178,7 +231,7 @@ class NeXtBottleneck(nn.Module):
         out = self.relu(out)
         #out = self.A(self.relu(out))
         
-        if self.deform>0:
+        if self.deform>0 and not self.fusedeform:
             out = self.offset2(out)
             #print self.deform
         out = self.conv2(out)
@@ -195,23 +248,7 @@ class NeXtBottleneck(nn.Module):
             residual = self.downsample(x)
 
         if self.sqex:
-            out_sqex = self.pool3(out)
-            out_sqex = self.fc31(out_sqex.view(out_sqex.size(0),-1))
-            out_sqex = self.fc32(out_sqex)
-            out_sqex = self.sigmoid(out_sqex)
-            
-            if self.ratt:
-                out_ratt = self.conv41(out)
-                out_ratt = self.conv42(out_ratt)
-                out_ratt = self.sigmoid(out_ratt)
-            
-            #print out_ratt.size()
-            
-            out = out * out_sqex.view(-1, int(self.planes * self.expansion),1,1)
-            
-            if self.ratt:
-                out = out * out_ratt
-            
+            out = self.segate(out)
             
         if not self.secord:
             out = out + residual
@@ -221,7 +258,7 @@ class NeXtBottleneck(nn.Module):
             out_side = self.conv1_secord2(x)
             out_side = self.bn1_secord2(out_side)
             out_side = self.relu(out_side)
-            if self.deform>0:
+            if self.deform>0 and not self.fusedeform:
                 out_side = self.offset2(out_side)
             out_side = self.conv2_secord2(out_side)
             out_side = self.bn2_secord2(out_side)
@@ -232,7 +269,7 @@ class NeXtBottleneck(nn.Module):
             out = out + residual
         elif self.secord == 3:
             out = self.relu(self.bn1(self.conv1(x)))
-            if self.deform>0:
+            if self.deform>0 and not self.fusedeform:
                 out = self.offset2(out)
             out_trunk = self.relu(self.bn2(self.conv2(out)))
             out_mask = self.relu(self.bn2_secord2(self.conv2_secord2(out)))
@@ -256,15 +293,18 @@ class NeXtBottleneck(nn.Module):
 class IRNeXt(nn.Module):
     # expansion = 4
     def __init__(self, inplanes, planes, stride=1, downsample=None, finer = 1, upgroup=False, downgroup=False, \
-                 expansion = 4, secord = False, soadd = 0.01, dil = 1, deform = 0):
+                 expansion = 4, secord = False, soadd = 0.01, dil = 1, deform = 0, offset_groups = None, fusedeform = 0):
         super(IRNeXt, self).__init__()
         self.secord = secord
         self.soadd = soadd
         self.expansion = expansion
         self.deform = deform
-        # Deformable Plugin
-        if self.deform>0:
-            self.offset2 = ConvOffset2D(planes)
+        # Fused Deformable: conv12 Samples Its Own Kernel Taps, No offset2
+        self.fusedeform = fusedeform if deform > 0 else 0
+        # Deformable Plugin, offset_groups: 0 -> One Offset Field Per Channel, N -> N Shared Fields,
+        # None -> Layer Default (One Per Channel For ConvOffset2D, One Shared For DeformConv2d)
+        if self.deform>0 and not self.fusedeform:
+            self.offset2 = ConvOffset2D(planes, offset_groups = offset_groups)
         else:
             pass
         
@@ -279,7 +319,11 @@ class IRNeXt(nn.Module):
         # Branch 1
         self.conv11 = nn.Conv2d(inplanes, planes, kernel_size=1, groups=int(32 * finer) if upgroup else 1, bias=False)
         self.bn11 = nn.BatchNorm2d(planes)
-        self.conv12 = nn.Conv2d(planes, deformable_planes, kernel_size=3, groups=int(32 * finer), stride=stride,
+        if self.fusedeform:
+            self.conv12 = DeformConv2d(planes, deformable_planes, kernel_size=3, groups=int(32 * finer), stride=stride,
+                               padding=dil, dilation=dil, bias=False, offset_groups=offset_groups)
+        else:
+            self.conv12 = nn.Conv2d(planes, deformable_planes, kernel_size=3, groups=int(32 * finer), stride=stride,
                                padding=dil, dilation=dil, bias=False)
         self.bn12 = nn.BatchNorm2d(deformable_planes)
         # Branch 2
@@ -309,7 +353,7 @@ class IRNeXt(nn.Module):
         left = self.conv11(x)
         left = self.bn11(left)
         left = self.relu(left)
-        if self.deform>0:
+        if self.deform>0 and not self.fusedeform:
             left = self.offset2(left)
             
         left = self.conv12(left)
@@ -406,9 +450,17 @@ class ResNet(nn.Module):
 
     
 class DeepLab_Classifier_Module(nn.Module):
-
-    def __init__(self, topfeatures, dilation_series,padding_series,nclass):
+    '''
+    ASPP: sum of 3x3 convs with dilations dilation_series over the same input.
+    Fused, all branches and taps run as one 1x1 conv (one read of the input, no
+    im2col of the dilated convs), and the shifted tap outputs are summed into one buffer.
+    fused = 1 fuses when no grad is needed (its backward is slower than the separate
+    convs), 2 always, 0 never.
+    '''
+
+    def __init__(self, topfeatures, dilation_series,padding_series,nclass, fused = 1):
         super(DeepLab_Classifier_Module, self).__init__()
+        self.fused = fused
         self.conv2d_list = nn.ModuleList()
         for dilation,padding in zip(dilation_series,padding_series):
             self.conv2d_list.append(\
@@ -419,12 +471,67 @@ class DeepLab_Classifier_Module(nn.Module):
 
 
     def forward(self, x):
+        if self.fused > 1 or (self.fused and not torch.is_grad_enabled()):
+            return self._forward_fused(x)
         out = self.conv2d_list[0](x)
         for i in range(len(self.conv2d_list)-1):
             out += self.conv2d_list[i+1](x)
         return out
-    
-    
+
+    def _forward_fused(self, x):
+        convs = self.conv2d_list
+        # Only Same-Size Branches: padding == dilation
+        assert all(m.padding[0] == m.dilation[0] and m.padding[1] == m.dilation[1] for m in convs)
+        nclass, k = convs[0].out_channels, convs[0].kernel_size[0]
+        b, h, w = x.size(0), x.size(2), x.size(3)
+
+        # (branches*k*k*nclass, c, 1, 1): tap (ky, kx) of every branch as a 1x1 conv
+        weight = torch.stack([m.weight for m in convs]).permute(0, 3, 4, 1, 2).reshape(-1, x.size(1), 1, 1)
+        taps = nn.functional.conv2d(x, weight)
+
+        # out[i, j] = sum of tap (ky, kx) at [i + (ky-1)*d, j + (kx-1)*d], zero outside
+        pad = max(max(m.dilation) for m in convs)
+        taps = nn.functional.pad(taps, [pad, pad, pad, pad])
+        out = sum(m.bias for m in convs).view(1, -1, 1, 1).expand(b, nclass, h, w).contiguous()
+        idx = 0
+        for m in convs:
+            dy, dx = m.dilation
+            for ky in range(k):
+                for kx in range(k):
+                    y0, x0 = pad + (ky - k // 2) * dy, pad + (kx - k // 2) * dx
+                    out.add_(taps[:, idx * nclass:(idx + 1) * nclass, y0:y0 + h, x0:x0 + w])
+                    idx += 1
+        return out
+
+
+class MultiwayClassifier(nn.Module):
+    '''
+    k Linear heads stacked in one weight (k, nclass, infeatures), computed as one GEMM.
+    Returns the sum over heads of their (log-)softmax, log = False for L1mode.
+    '''
+    def __init__(self, infeatures, nclass, multiway, log = True):
+        super(MultiwayClassifier, self).__init__()
+        self.infeatures = infeatures
+        self.nclass = nclass
+        self.multiway = multiway
+        self.log = log
+        self.weight = nn.Parameter(torch.empty(multiway, nclass, infeatures))
+        self.bias = nn.Parameter(torch.empty(multiway, nclass))
+        # Same Init As Each nn.Linear Head
+        stdv = 1. / math.sqrt(infeatures)
+        self.weight.data.uniform_(-stdv, stdv)
+        self.bias.data.uniform_(-stdv, stdv)
+
+    def forward(self, x):
+        # (b, k*nclass) -> (b, k, nclass)
+        out = nn.functional.linear(x, self.weight.view(-1, self.infeatures), self.bias.view(-1))
+        out = out.view(x.size(0), self.multiway, self.nclass)
+        if self.log:
+            out = nn.functional.log_softmax(out, dim=2)
+        else:
+            out = nn.functional.softmax(out, dim=2)
+        return out.sum(1)
+
 
 class ResNeXt(nn.Module):
 
@@ -432,8 +539,8 @@ class ResNeXt(nn.Module):
                 lastout = 7 , num_classes=1000, upgroup = False, downgroup = False, \
                 cifar = False , multiway = 0, L1mode = False, changeloss = False, expansion = 2,\
                  secord = False, soadd = 0.01, att = False, dilpat = '', deform = 0, fixx = 1, 
-                 sqex = 0, ratt = 0,
-                 taskmode='CLS', **kwargs):
+                 sqex = 0, ratt = 0, offset_groups = None, fusedeform = 0, channels_last = 0,
+                 checkpoint_segments = 0, att_chunk = 256, sereduce = 1, taskmode='CLS', **kwargs):
         self.lastout = lastout
         self.inplanes = 64
         self.num_classes = num_classes
@@ -447,11 +554,17 @@ class ResNeXt(nn.Module):
         self.secord = secord
         self.soadd = soadd
         self.attention = att
+        self.att_chunk = att_chunk
         self.dilpat = dilpat
         self.deform = deform
         self.fixx = fixx
         self.sqex = sqex
         self.ratt = ratt
+        self.sereduce = sereduce
+        self.offset_groups = offset_groups
+        self.fusedeform = fusedeform
+        self.channels_last = channels_last
+        self.checkpoint_segments = checkpoint_segments
         self.taskmode = taskmode
         
         if taskmode == 'CLS':
@@ -556,7 +669,11 @@ class ResNeXt(nn.Module):
         if self.verticalfrac == True:
             for bigidx, bigblock in enumerate(L):
                 for idx, layer in enumerate(bigblock):
-                    exec('self.layer_{bigidx}_{idx} = layer'.format(bigidx=bigidx, idx=idx))
+                    self.add_module('layer_{bigidx}_{idx}'.format(bigidx=bigidx, idx=idx), layer)
+            # Fractal Skip Topology, Compiled Once, No Skips From Block 0
+            self.frac_names = [['layer_{0}_{1}'.format(bigidx, idx) for idx in range(len(bigblock))] \
+                               for bigidx, bigblock in enumerate(L)]
+            self.frac_plan = [fractal.make_plan(len(bigblock), self.fracparam, first_skip=1) for bigblock in L]
 
         
         if taskmode == "CLS":
@@ -570,8 +687,10 @@ class ResNeXt(nn.Module):
             if multiway <= 0:
                 self.fc = nn.Linear(int(wider * 1024 * self.expansion * fc_multiple), num_classes)
             else:
-                for i in range(multiway):
-                    exec('self.fc_{0} = nn.Linear( int(wider*1024*self.expansion * fc_multiple), num_classes)'.format(i))
+                self.fc_multi = MultiwayClassifier(int(wider*1024*self.expansion * fc_multiple), num_classes, multiway,
+                                                   log = not L1mode)
+                # Checkpoints With Separate fc_0 .. fc_{k-1} Heads Still Load
+                self._register_load_state_dict_pre_hook(self._stack_multiway_heads)
 
         elif taskmode == "SEG":
             
@@ -588,10 +707,17 @@ class ResNeXt(nn.Module):
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
                 m.weight.data.normal_(0, math.sqrt(2. / n))
+            elif isinstance(m, DeformConv2d):
+                n = m.kernel_size * m.kernel_size * m.out_channels
+                m.weight.data.normal_(0, math.sqrt(2. / n))
             elif isinstance(m, nn.BatchNorm2d):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
 
+        # Channels Last: Weights And Activations Stay NHWC From Stem To Classifier
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+
     def _make_layer(self, block, planes, blocks, stride=1, finer=1, upgroup=False, downgroup=False, \
                     dilpat = '', deeplabdil = 1 , deform = 0,  sqex = 0, mapsize = None, ratt = 0):
         '''
@@ -638,13 +764,15 @@ class ResNeXt(nn.Module):
         
         layers.append(block(self.inplanes, planes, stride, downsample, finer, upgroup=upgroup, downgroup=downgroup,\
                            expansion = self.expansion, secord = self.secord, soadd = self.soadd, dil = dilate_plan[0],\
-                           deform = self.deform, sqex = self.sqex, mapsize = mapsize, ratt = self.ratt))
+                           deform = self.deform, sqex = self.sqex, mapsize = mapsize, ratt = self.ratt,\
+                           offset_groups = self.offset_groups, fusedeform = self.fusedeform, sereduce = self.sereduce))
 
         self.inplanes = int(planes * self.expansion)
         for i in range(1, blocks):
             layers.append(block(self.inplanes, planes, finer=finer, upgroup=upgroup, downgroup=downgroup, \
                            expansion = self.expansion, secord = self.secord, soadd = self.soadd, dil = dilate_plan[i],\
-                           deform = self.deform, sqex = self.sqex, mapsize = mapsize, ratt = self.ratt))
+                           deform = self.deform, sqex = self.sqex, mapsize = mapsize, ratt = self.ratt,\
+                           offset_groups = self.offset_groups, fusedeform = self.fusedeform, sereduce = self.sereduce))
 
         if self.verticalfrac == False:
             return nn.Sequential(*layers)
@@ -655,10 +783,69 @@ class ResNeXt(nn.Module):
     def _make_seg_pred_layer(self, block, topfeatures, dilation_series, padding_series, nclass):
         return block(topfeatures, dilation_series, padding_series, nclass)
 
+    def _class_attention_chunk(self, x, weight, bias):
+        x_side = nn.functional.conv2d(x, weight.unsqueeze(2).unsqueeze(3), bias)
+        return torch.sum(torch.mul(x_side, torch.exp(x_side)), dim=1, keepdim=True)
+
+    def _class_attention(self, x):
+        '''
+        Class attention map exp(sum_c z_c * exp(z_c)), z = fc applied at every pixel, as (b, 1, h, w).
+        The sum runs over chunks of att_chunk classes, and each chunk is recomputed in
+        backward, so no (b, num_classes, h, w) tensor is kept.
+        '''
+        x_attention = None
+        for start in range(0, self.num_classes, self.att_chunk):
+            weight = self.fc.weight[start:start + self.att_chunk]
+            bias = self.fc.bias[start:start + self.att_chunk]
+            if torch.is_grad_enabled():
+                chunk = checkpoint(self._class_attention_chunk, x, weight, bias, use_reentrant=False)
+            else:
+                chunk = self._class_attention_chunk(x, weight, bias)
+            x_attention = chunk if x_attention is None else x_attention + chunk
+        return torch.exp(x_attention)
+
+    def _stack_multiway_heads(self, state_dict, prefix, *args):
+        legacy = [prefix + 'fc_{0}.'.format(i) for i in range(self.multiway)]
+        if all(p + 'weight' in state_dict for p in legacy):
+            for name in ['weight', 'bias']:
+                state_dict[prefix + 'fc_multi.' + name] = torch.stack([state_dict.pop(p + name) for p in legacy])
+
+    def _frac_blocks(self, bigidx):
+        # By Name, So DataParallel Replicas Run Their Own Blocks
+        return [getattr(self, name) for name in self.frac_names[bigidx]]
+
+    def _run_frac_segment(self, blocks, plan, start, end, keys_in, keys_out, *tensors):
+        '''
+        Blocks [start, end) of a plan, from the live intermediates keys_in -> tensors.
+        Returns the intermediates live at the end, their keys are written to keys_out.
+        '''
+        outs = fractal.run_plan(blocks, plan, dict(zip(keys_in, tensors)), start, end)
+        keys_out[:] = sorted(outs)
+        return tuple(outs[k] for k in keys_out)
+
+    def _forward_frac_group_checkpointed(self, blocks, plan, outs, segments):
+        '''
+        fractal.run_plan recomputing each of `segments` runs of blocks in backward.
+        A segment takes every intermediate still live at its start (skip sources
+        included) and returns those still live at its end, so only segment
+        boundaries are kept for backward.
+        '''
+        bounds = np.linspace(0, len(plan), min(segments, len(plan)) + 1).astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            keys_in = sorted(outs)
+            keys_out = []
+            run_segment = functools.partial(self._run_frac_segment, blocks, plan, int(start), int(end), keys_in, keys_out)
+            tensors = checkpoint(run_segment, *[outs.pop(k) for k in keys_in], use_reentrant=False)
+            outs.update(zip(keys_out, tensors))
+        return outs.pop(len(plan) - 1)
+
     
     def forward(self, x):
         #print self.deform
         
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        
         x = self.conv1(x)
         
         x = self.bn1(x)
@@ -671,42 +858,32 @@ class ResNeXt(nn.Module):
             # To Avoid mean-rgb, use
             # x = self.relu(self.bn12(x))
 
+        # Activation Checkpointing: Recompute Block Segments In Backward
+        checkpointing = self.checkpoint_segments > 0 and torch.is_grad_enabled()
+        
         ## Vertical Frac ##
         if self.verticalfrac == False:
-            x = self.layer1(x)
-            x = self.layer2(x)
-            x = self.layer3(x)
-            if not self.cifar:
-                x = self.layer4(x)
-        else:
-            if self.cifar:
-                L = [self.layer1,self.layer2,self.layer3]
+            if checkpointing:
+                for layer in ([self.layer1,self.layer2,self.layer3] if self.cifar else \
+                              [self.layer1,self.layer2,self.layer3,self.layer4]):
+                    x = checkpoint_sequential(layer, min(self.checkpoint_segments, len(layer)), x,
+                                              use_reentrant=False)
             else:
-                L = [self.layer1,self.layer2,self.layer3,self.layer4]
-
-            for bigidx, bigblock in enumerate(L):
-                #blockinit = x
-                for idx, layer in enumerate(bigblock):
-                    tmpjump = 1
-                    if idx == 0:
-                        #print 'out_{bigidx}_{idx} = self.layer_{bigidx}_{idx}(x)'\
-                        #     .format(bigidx=bigidx,idx=idx)
-                        exec('out_{bigidx}_{idx} = self.layer_{bigidx}_{idx}(x)'\
-                             .format(bigidx=bigidx,idx=idx))
-                    else:
-                        #print 'out_{bigidx}_{idx} = self.layer_{bigidx}_{idx}(out_{bigidx}_{idxm})'\
-                        #     .format(bigidx=bigidx,idx=idx,idxm=idx-tmpjump)
-                        exec('out_{bigidx}_{idx} = self.layer_{bigidx}_{idx}(out_{bigidx}_{idxm})'\
-                             .format(bigidx=bigidx,idx=idx,idxm=idx-tmpjump))
-                        tmpjump = tmpjump * self.fracparam
-                        while idx - tmpjump > 0:
-                        #    print 'out_{bigidx}_{idx} = out_{bigidx}_{idx} + out_{bigidx}_{idxm}'\
-                        #         .format(bigidx=bigidx,idx=idx,idxm=idx-tmpjump)
-                            exec('out_{bigidx}_{idx} = out_{bigidx}_{idx} + out_{bigidx}_{idxm}'\
-                                 .format(bigidx=bigidx,idx=idx,idxm=idx-tmpjump))
-                            tmpjump = tmpjump * self.fracparam
-                #print 'x = out_{bigidx}_{idx}'.format(bigidx=bigidx,idx=len(bigblock)-1)
-                exec('x = out_{bigidx}_{idx}'.format(bigidx=bigidx,idx=len(bigblock)-1))
+                x = self.layer1(x)
+                x = self.layer2(x)
+                x = self.layer3(x)
+                if not self.cifar:
+                    x = self.layer4(x)
+        else:
+            for bigidx, plan in enumerate(self.frac_plan):
+                blocks = self._frac_blocks(bigidx)
+                # The dict owns the group input, so it is freed after its last use
+                outs = {-1: x}
+                x = None
+                if checkpointing:
+                    x = self._forward_frac_group_checkpointed(blocks, plan, outs, self.checkpoint_segments)
+                else:
+                    x = fractal.run_plan(blocks, plan, outs).pop(len(plan) - 1)
                 
         ## Vertical Frac End ##
         
@@ -722,25 +899,12 @@ class ResNeXt(nn.Module):
                     if self.changeloss:
                         x = self.sm(x)
                 else:
-                    xtmp = self.sm(  self.fc_0(x) )  # * ( 1.0 / self.multiway)
-                    for i in range(1, self.multiway):
-                        exec('xtmp = xtmp + self.sm( self.fc_{0}(x) ) '.format(i) )
-                    x = xtmp
+                    x = self.fc_multi(x)
             else:
             
-                newweight = torch.unsqueeze(torch.unsqueeze(self.fc.weight,2),3)
-                newbias = torch.unsqueeze(torch.unsqueeze(self.fc.bias,1),2)
-
-                x_side = torch.nn.functional.conv2d(x, weight = newweight, \
-                                                bias = newbias, stride=1, padding = 0)
-            
                 # Is this log-softmax necessary?
-                # x_side = self.sm(x_side)
-                x_side_exp = torch.exp(x_side)
-                x_attention = torch.exp(torch.sum(torch.mul(x_side,x_side_exp),dim=1))
-                #print 'num_classes: ', self.num_classes
                 #x_attention = torch.add(torch.sum(torch.mul(x_side,x_side_exp),dim=1), np.log(self.num_classes))
-                x_finale = torch.mul(x, torch.cat([x_attention for i in range(self.finaloutplane)],1))
+                x_finale = torch.mul(x, self._class_attention(x))
                 x = self.avgpool(x_finale)
                 x = x.view(x.size(0), -1)
             
@@ -750,10 +914,7 @@ class ResNeXt(nn.Module):
                     if self.changeloss:
                         x = self.sm(x)
                 else:
-                    xtmp = self.sm(  self.fc_0(x) )  # * ( 1.0 / self.multiway)
-                    for i in range(1, self.multiway):
-                        exec('xtmp = xtmp + self.sm( self.fc_{0}(x) ) '.format(i) )
-                    x = xtmp
+                    x = self.fc_multi(x)
         ## 2. Task Mode = Segmentation ##  
         elif self.taskmode == "SEG":
             
@@ -1082,6 +1243,20 @@ class ResNeXt_HGS(nn.Module):
 """
 
 
+def outS(i):
+    """Given the input size i of MS_Deeplab, returns the size j of its output
+    blob j x j x nclass: stride 2 conv1, maxpool and layer2, all rounding up"""
+    j = int(i)
+    j = (j+1)//2
+    j = (j+1)//2
+    j = (j+1)//2
+    return j
+
+
+# CUDA Streams Of MS_Deeplab Scales, Per Device
+_scale_streams = {}
+
+
 class MS_Deeplab(nn.Module):
     def __init__(self, block, numlayers, wider, finer, num_classes, expansion, secord = 0, soadd = 0.01, \
                  att = False, deform=0 , fixx=1, **kwargs):
@@ -1098,24 +1273,64 @@ class MS_Deeplab(nn.Module):
                    num_classes = num_classes, expansion = expansion, \
                    secord = secord, soadd = soadd, att= att, deform = deform, fixx = fixx, \
                      taskmode = "SEG", **kwargs )   #changed to fix #4 
+        self._sizes = {}
+
+    def _scale_sizes(self, height, width):
+        '''
+        Input sizes of the 0.75x and 0.5x scales and the output size, built once per input size
+        '''
+        key = (height, width)
+        if key not in self._sizes:
+            self._sizes[key] = ((int(height*0.75)+1, int(width*0.75)+1),
+                                (int(height*0.5)+1,  int(width*0.5)+1),
+                                (outS(height), outS(width)))
+        return self._sizes[key]
+
+    def _interp(self, x, size):
+        # Same As nn.UpsamplingBilinear2d, Skipped When Already At size
+        if tuple(x.size()[2:]) == tuple(size):
+            return x
+        return nn.functional.interpolate(x, size = size, mode = 'bilinear', align_corners = True)
+
+    def _run_scales(self, inputs):
+        if not (inputs[0].is_cuda and not torch.is_grad_enabled()):
+            return [self.Scale(x) for x in inputs]
+
+        # Inference On GPU: One Stream Per Scale, They Share No Intermediates
+        device = inputs[0].device
+        current = torch.cuda.current_stream(device)
+        if len(_scale_streams.get(device, [])) < len(inputs):
+            _scale_streams[device] = [torch.cuda.Stream(device) for x in inputs]
+        streams = _scale_streams[device]
+        outs = []
+        for stream, x in zip(streams, inputs):
+            stream.wait_stream(current)
+            x.record_stream(stream)
+            with torch.cuda.stream(stream):
+                outs.append(self.Scale(x))
+        for stream, out in zip(streams, outs):
+            current.wait_stream(stream)
+            out.record_stream(current)
+        return outs
 
     def forward( self, x):
-        input_size = x.size()[2]
-        self.interp1 = nn.UpsamplingBilinear2d(size = (  int(input_size*0.75)+1,  int(input_size*0.75)+1  ))
-        self.interp2 = nn.UpsamplingBilinear2d(size = (  int(input_size*0.5)+1,   int(input_size*0.5)+1   ))
-        self.interp3 = nn.UpsamplingBilinear2d(size = (  outS(input_size),   outS(input_size)   ))
-        out = []
-        x2 = self.interp1(x)
-        x3 = self.interp2(x)
-        out.append(self.Scale(x))    # for original scale
-        out.append(self.interp3(self.Scale(x2)))    # for 0.75x scale
-        out.append(self.Scale(x3))    # for 0.5x scale
-
-
-        x2Out_interp = out[1]
-        x3Out_interp = self.interp3(out[2])
-        temp1 = torch.max(out[0],x2Out_interp)
-        out.append(torch.max(temp1,x3Out_interp))
+        size2, size3, sizeout = self._scale_sizes(x.size(2), x.size(3))
+        x2 = self._interp(x, size2)
+        x3 = self._interp(x, size3)
+        out = self._run_scales([x, x2, x3])    # 1.0x, 0.75x, 0.5x scale
+        
+        # out[2] Stays At 0.5x Scale, Each Branch Is Interpolated Exactly Once
+        x2Out_interp = self._interp(out[1], sizeout)
+        x3Out_interp = self._interp(out[2], sizeout)
+        out[1] = x2Out_interp
+        
+        if torch.is_grad_enabled():
+            fused = torch.max(torch.max(out[0], x2Out_interp), x3Out_interp)
+        else:
+            # Max-Fuse In Place Into One Output Buffer
+            fused = torch.max(out[0], x2Out_interp)
+            torch.max(fused, x3Out_interp, out=fused)
+        out.append(fused)
         return out
 
 
@@ -0,0 +1,100 @@
+"""Parity and throughput check of th_batch_map_offsets
+
+Compares th_batch_map_offsets against the vectorized NumPy reference
+np_batch_map_offsets (computed in float64) across batch sizes, map sizes and
+dtypes, and reports the max error and the sampled points per second of both.
+
+Usage (from imagenet/):
+    python -m torch_deform_conv.benchmark --batch-sizes 32,256 --map-sizes 7,14,28x14
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from torch_deform_conv.deform_conv import th_batch_map_offsets, np_batch_map_offsets, \
+    sp_batch_map_offsets
+
+
+def parse_map_size(s):
+    """'14' -> (14, 14), '28x14' -> (28, 14)"""
+    if 'x' in s:
+        h, w = s.split('x')
+        return int(h), int(w)
+    return int(s), int(s)
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time.time()
+    for _ in range(repeats):
+        out = fn()
+    return out, (time.time() - start) / repeats
+
+
+def check(batch_size, map_size, dtype, device='cpu', repeats=10, offset_scale=2.0, scipy=False):
+    """Returns a dict of max errors and points/sec for one configuration"""
+    h, w = map_size
+    input = np.random.rand(batch_size, h, w)
+    offsets = np.random.randn(batch_size, h, w, 2) * offset_scale
+
+    ref, ref_time = timeit(lambda: np_batch_map_offsets(input, offsets), max(repeats // 5, 1))
+
+    th_input = torch.from_numpy(input).to(device=device, dtype=dtype)
+    th_offsets = torch.from_numpy(offsets).to(device=device, dtype=dtype)
+
+    def run():
+        with torch.no_grad():
+            out = th_batch_map_offsets(th_input, th_offsets)
+        if th_input.is_cuda:
+            torch.cuda.synchronize()
+        return out
+
+    out, th_time = timeit(run, repeats)
+    n_points = batch_size * h * w
+    res = {
+        'max_err': float(np.abs(out.double().cpu().numpy() - ref).max()),
+        'th_points_per_sec': n_points / th_time,
+        'np_points_per_sec': n_points / ref_time,
+    }
+    if scipy:
+        res['sp_max_err'] = float(np.abs(sp_batch_map_offsets(input, offsets) - ref).max())
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='th_batch_map_offsets parity and benchmark')
+    parser.add_argument('--batch-sizes', default='1,32,256', type=str)
+    parser.add_argument('--map-sizes', default='7,14,28,56', type=str,
+                        help='comma separated, S or HxW')
+    parser.add_argument('--dtypes', default='float32,float64', type=str,
+                        help='comma separated torch dtypes, e.g. float16,bfloat16')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--repeats', default=10, type=int)
+    parser.add_argument('--offset-scale', default=2.0, type=float,
+                        help='std of the random offsets, in pixels')
+    parser.add_argument('--scipy', default=0, type=int,
+                        help='also check the NumPy reference against scipy')
+    args = parser.parse_args()
+
+    print('{:>6} {:>8} {:>9} {:>10} {:>14} {:>14}'.format(
+        'batch', 'map', 'dtype', 'max_err', 'th_pts/s', 'np_pts/s'))
+    for dtype_name in args.dtypes.split(','):
+        dtype = getattr(torch, dtype_name)
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            for map_size in [parse_map_size(m) for m in args.map_sizes.split(',')]:
+                res = check(batch_size, map_size, dtype, args.device, args.repeats,
+                            args.offset_scale, args.scipy)
+                line = '{:>6} {:>8} {:>9} {:>10.3e} {:>14.4g} {:>14.4g}'.format(
+                    batch_size, '{}x{}'.format(*map_size), dtype_name, res['max_err'],
+                    res['th_points_per_sec'], res['np_points_per_sec'])
+                if args.scipy:
+                    line += ' sp_err {:.3e}'.format(res['sp_max_err'])
+                print(line)
+
+
+if __name__ == '__main__':
+    main()
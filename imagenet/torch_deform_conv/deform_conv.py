@@ -1,10 +1,16 @@
 from __future__ import absolute_import, division
 
+from collections import OrderedDict
+
 import torch
-from torch.autograd import Variable
+from torch.autograd.function import once_differentiable
 
 import numpy as np
-from scipy.ndimage.interpolation import map_coordinates as sp_map_coordinates
+try:
+    from scipy.ndimage import map_coordinates as sp_map_coordinates
+except ImportError:
+    # Only the sp_* reference functions need scipy, see np_batch_map_offsets
+    sp_map_coordinates = None
 
 
 def th_flatten(a):
@@ -56,7 +62,7 @@ def th_map_coordinates(input, coords, order=1):
     vals_lb = th_gather_2d(input,  coords_lb.detach())
     vals_rt = th_gather_2d(input,  coords_rt.detach())
 
-    coords_offset_lt = coords - coords_lt.type(coords.data.type())
+    coords_offset_lt = coords - coords_lt.type_as(coords)
 
     vals_t = vals_lt + (vals_rt - vals_lt) * coords_offset_lt[:, 0]
     vals_b = vals_lb + (vals_rb - vals_lb) * coords_offset_lt[:, 0]
@@ -66,7 +72,7 @@ def th_map_coordinates(input, coords, order=1):
 
 def sp_batch_map_coordinates(inputs, coords):
     """Reference implementation for batch_map_coordinates"""
-    coords = coords.clip(0, inputs.shape[1] - 1)
+    coords = coords.clip(0, np.array(inputs.shape[1:3]) - 1)
     mapped_vals = np.array([
         sp_map_coordinates(input, coord.T, mode='nearest', order=1)
         for input, coord in zip(inputs, coords)
@@ -74,100 +80,384 @@ def sp_batch_map_coordinates(inputs, coords):
     return mapped_vals
 
 
+def th_accumulate_dtype(dtype):
+    """Dtype of coords and interpolation weights for a feature map dtype
+
+    float16/bfloat16 cannot hold sub-pixel positions of larger maps, so
+    coords, weights and accumulation stay in float32 for them
+    """
+    if dtype in (torch.float16, torch.bfloat16):
+        return torch.float32
+    return dtype
+
+
+# Batch index and grid caches, least recently used first. Bounded, so a stream of
+# batch and input sizes (multi-scale training, variable eval sizes) cannot grow them
+# without limit. See clear_grid_caches
+GRID_CACHE_SIZE = 64
+
+
+def _cache_get(cache, key):
+    value = cache.pop(key, None)
+    if value is not None:
+        cache[key] = value
+    return value
+
+
+def _cache_put(cache, key, value):
+    while len(cache) >= GRID_CACHE_SIZE:
+        cache.popitem(last=False)
+    cache[key] = value
+
+
+_batch_offsets = OrderedDict()
+
+
+def th_batch_offsets(batch_size, map_size, device):
+    """Offsets of each sample into a flattened batch, shape = (b, 1)
+
+    Cached by (batch_size, map_size, device) so the batch index is not rebuilt
+    on every forward pass, the GRID_CACHE_SIZE most recently used are kept
+    """
+    key = (batch_size, map_size, device)
+    offsets = _cache_get(_batch_offsets, key)
+    if offsets is None:
+        offsets = torch.arange(0, batch_size, device=device).long() * map_size
+        offsets = offsets.view(batch_size, 1)
+        _cache_put(_batch_offsets, key, offsets)
+    return offsets
+
+
+def _th_corner_indices(rows_t, cols_l, height, width):
+    """Flat indices of the lt, rt, lb, rb corners, shape = (b, 4, n_points)"""
+    rows_b = torch.clamp(rows_t + 1, max=height - 1)
+    cols_r = torch.clamp(cols_l + 1, max=width - 1)
+    return torch.stack([
+        rows_t*width + cols_l, rows_b*width + cols_l,
+        rows_t*width + cols_r, rows_b*width + cols_r
+    ], 1)
+
+
+def _th_gather_corners(input, inds):
+    """Gather the corners with a single index_select (3D) or gather (4D)
+
+    Returns shape = (b, 4, n_points) or (b, c, 4, n_points)
+    """
+    batch_size, n_coords = inds.size(0), inds.size(2)
+    if input.dim() == 3:
+        batch_offsets = th_batch_offsets(batch_size, input.size(1)*input.size(2), input.device)
+        inds = inds + batch_offsets.view(batch_size, 1, 1)
+        vals = th_flatten(input).index_select(0, th_flatten(inds))
+        return vals.view(batch_size, 4, n_coords)
+    n_channels = input.size(1)
+    inds = inds.view(batch_size, 1, 4*n_coords).expand(batch_size, n_channels, 4*n_coords)
+    vals = input.contiguous().view(batch_size, n_channels, -1).gather(2, inds)
+    return vals.view(batch_size, n_channels, 4, n_coords)
+
+
+def _th_scatter_corners(grads, inds, input_size):
+    """Transpose of _th_gather_corners, sums grads into a zero input-sized tensor"""
+    batch_size, n_coords = inds.size(0), inds.size(2)
+    grad_input = grads.new_zeros(input_size)
+    if len(input_size) == 3:
+        batch_offsets = th_batch_offsets(batch_size, input_size[1]*input_size[2], grads.device)
+        inds = inds + batch_offsets.view(batch_size, 1, 1)
+        grad_input.view(-1).index_add_(0, th_flatten(inds), th_flatten(grads))
+        return grad_input
+    n_channels = input_size[1]
+    inds = inds.view(batch_size, 1, 4*n_coords).expand(batch_size, n_channels, 4*n_coords)
+    grads = grads.contiguous().view(batch_size, n_channels, 4*n_coords)
+    grad_input.view(batch_size, n_channels, -1).scatter_add_(2, inds, grads)
+    return grad_input
+
+
+def _th_bilinear_sample(input, coords):
+    """Forward of BatchMapCoordinates, plain tensor ops
+
+    Returns the sampled values and (rows_t, cols_l, rows_offset, cols_offset,
+    in_range), the tensors its backward needs
+    """
+    height, width = input.size(-2), input.size(-1)
+    acc_dtype = th_accumulate_dtype(torch.promote_types(input.dtype, coords.dtype))
+    coords = coords.to(acc_dtype)
+
+    in_range = (coords >= 0) & (coords <= coords.new_tensor([height - 1, width - 1]))
+    rows = torch.clamp(coords[..., 0], 0, height - 1)
+    cols = torch.clamp(coords[..., 1], 0, width - 1)
+    rows_t = rows.floor()
+    cols_l = cols.floor()
+    rows_offset = rows - rows_t
+    cols_offset = cols - cols_l
+    rows_t = rows_t.long()
+    cols_l = cols_l.long()
+
+    vals = _th_gather_corners(input, _th_corner_indices(rows_t, cols_l, height, width))
+    vals = vals.to(acc_dtype)
+    saved = (rows_t, cols_l, rows_offset, cols_offset, in_range)
+
+    if input.dim() == 4:
+        rows_offset = rows_offset.unsqueeze(1)
+        cols_offset = cols_offset.unsqueeze(1)
+    vals_lt, vals_rt = vals[..., 0, :], vals[..., 1, :]
+    vals_lb, vals_rb = vals[..., 2, :], vals[..., 3, :]
+
+    vals_t = rows_offset*(vals_rt - vals_lt) + vals_lt
+    vals_b = rows_offset*(vals_rb - vals_lb) + vals_lb
+    mapped_vals = cols_offset* (vals_b - vals_t) + vals_t
+    return mapped_vals.to(input.dtype), saved
+
+
+class BatchMapCoordinates(torch.autograd.Function):
+    """Bilinear sampling of th_batch_map_coordinates with an analytic backward
+
+    Only the floor indices, the fractional weights and the clamp mask are
+    saved, plus a reference to the input. Backward scatter-adds into the input
+    gradient and computes the coords gradient directly from the corners
+
+    For float16/bfloat16 inputs the interpolation is accumulated in float32
+    and only the result is cast back, see th_accumulate_dtype
+    """
+
+    @staticmethod
+    def forward(ctx, input, coords):
+        ctx.coords_dtype = coords.dtype
+        mapped_vals, saved = _th_bilinear_sample(input, coords)
+        ctx.save_for_backward(input, *saved)
+        return mapped_vals
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        input, rows_t, cols_l, rows_offset, cols_offset, in_range = ctx.saved_tensors
+        grad_output = grad_output.to(rows_offset.dtype)
+        inds = _th_corner_indices(rows_t, cols_l, input.size(-2), input.size(-1))
+        if input.dim() == 4:
+            rows_offset = rows_offset.unsqueeze(1)
+            cols_offset = cols_offset.unsqueeze(1)
+
+        grad_input = grad_coords = None
+        if ctx.needs_input_grad[0]:
+            weights = torch.stack([
+                (1 - rows_offset)*(1 - cols_offset), rows_offset*(1 - cols_offset),
+                (1 - rows_offset)*cols_offset, rows_offset*cols_offset
+            ], -2)
+            grad_input = _th_scatter_corners(weights*grad_output.unsqueeze(-2), inds, input.size())
+            grad_input = grad_input.to(input.dtype)
+
+        if ctx.needs_input_grad[1]:
+            vals = _th_gather_corners(input, inds).to(grad_output.dtype)
+            vals_lt, vals_rt = vals[..., 0, :], vals[..., 1, :]
+            vals_lb, vals_rb = vals[..., 2, :], vals[..., 3, :]
+            grad_rows = grad_output*((1 - cols_offset)*(vals_rt - vals_lt) + cols_offset*(vals_rb - vals_lb))
+            grad_cols = grad_output*((1 - rows_offset)*(vals_lb - vals_lt) + rows_offset*(vals_rb - vals_rt))
+            if input.dim() == 4:
+                # channels of a group share the coords
+                grad_rows = grad_rows.sum(1)
+                grad_cols = grad_cols.sum(1)
+            grad_coords = torch.stack([grad_rows, grad_cols], -1) * in_range.type_as(grad_rows)
+            grad_coords = grad_coords.to(ctx.coords_dtype)
+
+        return grad_input, grad_coords
+
+
 def th_batch_map_coordinates(input, coords, order=1):
     """Batch version of th_map_coordinates
     Only supports 2D feature maps
+
+    The four corner indices are computed in one pass and gathered from the
+    flattened input with a single index_select. A 4D input is a group of
+    channels sharing the same coords, the indices are computed once and
+    gathered for every channel of the group. See BatchMapCoordinates for
+    the backward pass. Under torch.jit.trace the plain ops are recorded
+    instead, so traced models can be saved (see deploy.py)
     Parameters
     ----------
-    input : tf.Tensor. shape = (b, s, s)
+    input : tf.Tensor. shape = (b, h, w) or (b, c, h, w)
     coords : tf.Tensor. shape = (b, n_points, 2)
     Returns
     -------
-    tf.Tensor. shape = (b, s, s)
+    tf.Tensor. shape = (b, n_points) or (b, c, n_points)
     """
+    assert order == 1
+    if torch.jit.is_tracing():
+        return _th_bilinear_sample(input, coords)[0]
+    return BatchMapCoordinates.apply(input, coords)
 
-    batch_size = input.size(0)
-    input_size = input.size(1)
-    n_coords = coords.size(1)
 
-    coords = torch.clamp(coords, 0, input_size - 1)
-    coords_lt = coords.floor().long()
-    coords_rb = coords.ceil().long()
-    coords_lb = torch.stack([coords_lt[..., 0], coords_rb[..., 1]], 2)
-    coords_rt = torch.stack([coords_rb[..., 0], coords_lt[..., 1]], 2)
-    idx = th_repeat(torch.range(0, batch_size-1), n_coords).long()
-    idx = Variable(idx, requires_grad=False)
-    if input.is_cuda:
-        idx = idx.cuda()
-
-    def _get_vals_by_coords(input, coords):
-        indices = torch.stack([
-            idx, th_flatten(coords[..., 0]), th_flatten(coords[..., 1])
-        ], 1)
-        inds = indices[:, 0]*input.size(1)*input.size(2)+ indices[:, 1]*input.size(2) + indices[:, 2]
-        vals = th_flatten(input).index_select(0, inds)
-        vals = vals.view(batch_size, n_coords)
-        return vals
-    
-    vals_lt = _get_vals_by_coords(input, coords_lt.detach())
-    vals_rb = _get_vals_by_coords(input, coords_rb.detach())
-    vals_lb = _get_vals_by_coords(input, coords_lb.detach())
-    vals_rt = _get_vals_by_coords(input, coords_rt.detach())
-
-    coords_offset_lt = coords - coords_lt.type(coords.data.type())
-    vals_t = coords_offset_lt[..., 0]*(vals_rt - vals_lt) + vals_lt
-    vals_b = coords_offset_lt[..., 0]*(vals_rb - vals_lb) + vals_lb
-    mapped_vals = coords_offset_lt[..., 1]* (vals_b - vals_t) + vals_t
+def np_batch_map_coordinates(inputs, coords):
+    """Vectorized NumPy reference implementation for batch_map_coordinates
+
+    Same result as sp_batch_map_coordinates without scipy and without a
+    Python loop over the batch
+    Parameters
+    ----------
+    inputs : np.ndarray. shape = (b, h, w)
+    coords : np.ndarray. shape = (b, n_points, 2)
+    Returns
+    -------
+    np.ndarray. shape = (b, n_points)
+    """
+    max_coords = np.array(inputs.shape[1:3]) - 1
+    coords = coords.clip(0, max_coords)
+    coords_lt = np.floor(coords).astype(np.int64)
+    coords_rb = np.minimum(coords_lt + 1, max_coords)
+    coords_offset = coords - coords_lt
+
+    batch = np.arange(inputs.shape[0])[:, None]
+    vals_lt = inputs[batch, coords_lt[..., 0], coords_lt[..., 1]]
+    vals_rt = inputs[batch, coords_rb[..., 0], coords_lt[..., 1]]
+    vals_lb = inputs[batch, coords_lt[..., 0], coords_rb[..., 1]]
+    vals_rb = inputs[batch, coords_rb[..., 0], coords_rb[..., 1]]
+
+    vals_t = vals_lt + (vals_rt - vals_lt) * coords_offset[..., 0]
+    vals_b = vals_lb + (vals_rb - vals_lb) * coords_offset[..., 0]
+    mapped_vals = vals_t + (vals_b - vals_t) * coords_offset[..., 1]
+    return mapped_vals
+
+
+def np_batch_map_offsets(input, offsets):
+    """Vectorized NumPy reference implementation for th_batch_map_offsets"""
+
+    batch_size = input.shape[0]
+    input_size = input.shape[1:3]
+
+    offsets = offsets.reshape(batch_size, -1, 2)
+    grid = np.stack(np.mgrid[:input_size[0], :input_size[1]], -1).reshape(1, -1, 2)
+    coords = offsets + grid
+
+    mapped_vals = np_batch_map_coordinates(input, coords)
     return mapped_vals
 
 
+def th_map_points(input, index, coords):
+    """Bilinear sampling of scattered points, each from its own sample
+    Parameters
+    ----------
+    input : torch.Tensor. shape = (b, h, w) or (b, c, h, w)
+    index : torch.LongTensor. shape = (n_points,), sample of each point
+    coords : torch.Tensor. shape = (n_points, 2)
+    Returns
+    -------
+    torch.Tensor. shape = (n_points, c), c = 1 for a 3D input
+    """
+    height, width = input.size(-2), input.size(-1)
+    input = input.contiguous().view(input.size(0), -1, height*width)
+    acc_dtype = th_accumulate_dtype(torch.promote_types(input.dtype, coords.dtype))
+    coords = coords.to(acc_dtype)
+
+    rows = torch.clamp(coords[:, 0], 0, height - 1)
+    cols = torch.clamp(coords[:, 1], 0, width - 1)
+    rows_t = rows.floor()
+    cols_l = cols.floor()
+    rows_offset = (rows - rows_t).unsqueeze(1)
+    cols_offset = (cols - cols_l).unsqueeze(1)
+
+    # vals: (n_points, 4, c)
+    inds = _th_corner_indices(rows_t.long(), cols_l.long(), height, width)
+    vals = input[index.unsqueeze(1), :, inds].to(acc_dtype)
+    vals_lt, vals_rt, vals_lb, vals_rb = vals[:, 0], vals[:, 1], vals[:, 2], vals[:, 3]
+
+    vals_t = rows_offset*(vals_rt - vals_lt) + vals_lt
+    vals_b = rows_offset*(vals_rb - vals_lb) + vals_lb
+    mapped_vals = cols_offset* (vals_b - vals_t) + vals_t
+    return mapped_vals.to(input.dtype)
+
+
 def sp_batch_map_offsets(input, offsets):
     """Reference implementation for tf_batch_map_offsets"""
 
     batch_size = input.shape[0]
-    input_size = input.shape[1]
+    input_size = input.shape[1:3]
 
     offsets = offsets.reshape(batch_size, -1, 2)
-    grid = np.stack(np.mgrid[:input_size, :input_size], -1).reshape(-1, 2)
+    grid = np.stack(np.mgrid[:input_size[0], :input_size[1]], -1).reshape(-1, 2)
     grid = np.repeat([grid], batch_size, axis=0)
     coords = offsets + grid
-    coords = coords.clip(0, input_size - 1)
+    coords = coords.clip(0, np.array(input_size) - 1)
 
     mapped_vals = sp_batch_map_coordinates(input, coords)
     return mapped_vals
 
 
-def th_generate_grid(batch_size, input_size, dtype, cuda):
-    grid = np.meshgrid(
-        range(input_size), range(input_size), indexing='ij'
-    )
-    grid = np.stack(grid, axis=-1)
-    grid = grid.reshape(-1, 2)
+_grids = OrderedDict()
+_conv_grids = OrderedDict()
 
-    grid = np_repeat_2d(grid, batch_size)
-    grid = torch.from_numpy(grid).type(dtype)
-    if cuda:
-        grid = grid.cuda()
-    return Variable(grid, requires_grad=False)
+
+def clear_grid_caches():
+    """Drops every cached sampling grid and batch index, e.g. to release device memory"""
+    _batch_offsets.clear()
+    _grids.clear()
+    _conv_grids.clear()
+
+
+def th_generate_grid(input_size, dtype, device):
+    """Sampling grid of a (h, w) map, shape = (1, h*w, 2)
+
+    Built directly on the device and cached by (h, w, dtype, device), so maps
+    of different sizes (e.g. multi-scale inputs) each keep their own grid, up
+    to the GRID_CACHE_SIZE most recently used. The leading dim broadcasts over
+    the batch. dtype should be the accumulation dtype, see th_accumulate_dtype
+    """
+    if isinstance(input_size, int):
+        input_size = (input_size, input_size)
+    height, width = input_size
+    key = (height, width, dtype, device)
+    grid = _cache_get(_grids, key)
+    if grid is None:
+        rows = torch.arange(0, height, dtype=dtype, device=device)
+        cols = torch.arange(0, width, dtype=dtype, device=device)
+        grid = torch.stack([
+            rows.view(height, 1).expand(height, width),
+            cols.view(1, width).expand(height, width)
+        ], -1)
+        grid = grid.view(1, height*width, 2)
+        _cache_put(_grids, key, grid)
+    return grid
+
+
+def th_generate_conv_grid(output_size, kernel_size, stride, dilation, dtype, device):
+    """Kernel-tap sampling grid of a convolution, shape = (1, k*k*h_out*w_out, 2)
+
+    Position of tap (ki, kj) for output (i, j) is
+    (i*stride + ki*dilation, j*stride + kj*dilation) in the padded input,
+    ordered tap-major. Cached like th_generate_grid
+    """
+    height, width = output_size
+    key = (height, width, kernel_size, stride, dilation, dtype, device)
+    grid = _cache_get(_conv_grids, key)
+    if grid is None:
+        taps = torch.arange(0, kernel_size, dtype=dtype, device=device) * dilation
+        rows = torch.arange(0, height, dtype=dtype, device=device) * stride
+        cols = torch.arange(0, width, dtype=dtype, device=device) * stride
+        shape = (kernel_size, kernel_size, height, width)
+        grid = torch.stack([
+            (taps.view(-1, 1, 1, 1) + rows.view(1, 1, -1, 1)).expand(*shape),
+            (taps.view(1, -1, 1, 1) + cols.view(1, 1, 1, -1)).expand(*shape)
+        ], -1)
+        grid = grid.view(1, -1, 2)
+        _cache_put(_conv_grids, key, grid)
+    return grid
 
 
 def th_batch_map_offsets(input, offsets, grid=None, order=1):
     """Batch map offsets into input
     Parameters
     ---------
-    input : torch.Tensor. shape = (b, s, s)
-    offsets: torch.Tensor. shape = (b, s, s, 2)
+    input : torch.Tensor. shape = (b, h, w) or (b, c, h, w)
+    offsets: torch.Tensor. shape = (b, h, w, 2)
+    grid: torch.Tensor. shape = (1, h*w, 2), see th_generate_grid
     Returns
     -------
-    torch.Tensor. shape = (b, s, s)
+    torch.Tensor. shape = (b, h*w) or (b, c, h*w)
     """
     batch_size = input.size(0)
-    input_size = input.size(1)
+    input_size = (input.size(-2), input.size(-1))
 
     offsets = offsets.view(batch_size, -1, 2)
     if grid is None:
-        grid = th_generate_grid(batch_size, input_size, offsets.data.type(), offsets.data.is_cuda)
+        grid = th_generate_grid(input_size, th_accumulate_dtype(offsets.dtype), offsets.device)
 
+    # coords in the accumulation dtype, float32 for float16/bfloat16 offsets
     coords = offsets + grid
 
     mapped_vals = th_batch_map_coordinates(input, coords)
@@ -1,10 +1,22 @@
 from __future__ import absolute_import, division
 
+import math
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.hooks as hooks
+
+from torch_deform_conv.deform_conv import th_batch_map_offsets, th_generate_grid, \
+    th_batch_map_coordinates, th_generate_conv_grid, th_map_points, th_accumulate_dtype
+
 
-import numpy as np
-from torch_deform_conv.deform_conv import th_batch_map_offsets, th_generate_grid
+def _memory_format(x):
+    """torch.channels_last if x is a channels-last 4D tensor, else contiguous_format"""
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
 
 
 class ConvOffset2D(nn.Conv2d):
@@ -15,8 +27,18 @@ class ConvOffset2D(nn.Conv2d):
 
     Note that this layer does not perform convolution on the deformed feature
     map. See get_deform_cnn in cnn.py for usage
+
+    In eval mode with fast_threshold > 0, offsets whose magnitude stays below
+    the threshold are treated as zero: the whole map, or each fast_tile x
+    fast_tile tile, is returned as is without sampling. fast_stats counts how
+    often that happened. See set_fast_path
+
+    register_offset_hook gives access to the predicted offsets without
+    keeping them alive, see recorder.OffsetRecorder
+
+    Sampling runs in NCHW, the output keeps the memory format of the input
     """
-    def __init__(self, filters, init_normal_stddev=0.01, **kwargs):
+    def __init__(self, filters, init_normal_stddev=0.01, offset_groups=None, **kwargs):
         """Init
 
         Parameters
@@ -25,53 +47,113 @@ class ConvOffset2D(nn.Conv2d):
             Number of channel of the input feature map
         init_normal_stddev : float
             Normal kernel initialization
+        offset_groups : int
+            Number of offset fields, each shared by filters/offset_groups
+            channels. 0 or None (the default): one field per channel
         **kwargs:
             Pass to superclass. See Con2d layer in pytorch
         """
         self.filters = filters
-        self._grid_param = None
-        super(ConvOffset2D, self).__init__(self.filters, self.filters*2, 3, padding=1, bias=False, **kwargs)
+        self.offset_groups = offset_groups or filters
+        assert self.offset_groups > 0 and self.filters % self.offset_groups == 0
+        super(ConvOffset2D, self).__init__(self.filters, self.offset_groups*2, 3, padding=1, bias=False, **kwargs)
         self.weight.data.copy_(self._init_weights(self.weight, init_normal_stddev))
+        self._offset_hooks = OrderedDict()
+        self.set_fast_path(0)
+
+    def register_offset_hook(self, hook):
+        """Call hook(module, offsets) with the raw (b, 2g, h, w) offsets on every forward
+
+        Returns a handle, handle.remove() unregisters the hook
+        """
+        handle = hooks.RemovableHandle(self._offset_hooks)
+        self._offset_hooks[handle.id] = hook
+        return handle
+
+    def set_fast_path(self, threshold, tile=0):
+        """Enable the identity fast path for eval mode, threshold = 0 disables it
+
+        Parameters
+        ----------
+        threshold : float
+            Max absolute offset (in pixels) still treated as no offset
+        tile : int
+            Tile size of the per-region check, 0 only checks the whole map
+        """
+        self.fast_threshold = threshold
+        self.fast_tile = tile
+        self.fast_stats = {'calls': 0, 'skipped_calls': 0, 'tiles': 0, 'skipped_tiles': 0}
 
     def forward(self, x):
         """Return the deformed featured map"""
         x_shape = x.size()
+        memory_format = _memory_format(x)
         offsets = super(ConvOffset2D, self).forward(x)
+        for hook in self._offset_hooks.values():
+            hook(self, offsets)
 
-        # offsets: (b*c, h, w, 2)
+        # offsets: (b*g, h, w, 2)
         offsets = self._to_bc_h_w_2(offsets, x_shape)
 
-        # x: (b*c, h, w)
-        x = self._to_bc_h_w(x, x_shape)
+        if self.fast_threshold > 0 and not self.training:
+            return self._forward_fast(x, offsets, x_shape).contiguous(memory_format=memory_format)
 
-        # X_offset: (b*c, h, w)
+        if self.offset_groups == self.filters:
+            # x: (b*c, h, w)
+            x = self._to_bc_h_w(x, x_shape)
+        else:
+            # x: (b*g, c/g, h, w)
+            x = self._to_bg_cg_h_w(x, x_shape, self.offset_groups)
+
+        # X_offset: (b*c, h*w) or (b*g, c/g, h*w)
         x_offset = th_batch_map_offsets(x, offsets, grid=self._get_grid(self,x))
 
         # x_offset: (b, h, w, c)
         x_offset = self._to_b_c_h_w(x_offset, x_shape)
 
-        return x_offset
+        return x_offset.contiguous(memory_format=memory_format)
+
+    def _forward_fast(self, x, offsets, x_shape):
+        """Forward that only samples where offsets reach fast_threshold"""
+        self.fast_stats['calls'] += 1
+        # magnitude: (b*g, h, w)
+        magnitude = offsets.detach().abs().max(-1)[0]
+        if float(magnitude.max()) < self.fast_threshold:
+            self.fast_stats['skipped_calls'] += 1
+            return x
+
+        # x: (b*g, c/g, h, w)
+        x = self._to_bg_cg_h_w(x, x_shape, self.offset_groups)
+        if self.fast_tile <= 0:
+            x_offset = th_batch_map_offsets(x, offsets, grid=self._get_grid(self,x))
+            return self._to_b_c_h_w(x_offset, x_shape)
+
+        height, width, tile = int(x_shape[2]), int(x_shape[3]), self.fast_tile
+        active = F.max_pool2d(magnitude.unsqueeze(1), tile, ceil_mode=True).squeeze(1) >= self.fast_threshold
+        self.fast_stats['tiles'] += active.numel()
+        self.fast_stats['skipped_tiles'] += active.numel() - int(active.sum())
+
+        active = active.repeat_interleave(tile, 1).repeat_interleave(tile, 2)[:, :height, :width]
+        index, rows, cols = active.nonzero(as_tuple=True)
+        grid = torch.stack([rows, cols], 1).to(th_accumulate_dtype(offsets.dtype))
+        coords = offsets[index, rows, cols] + grid
+
+        x_offset = x.clone()
+        x_offset.view(x.size(0), x.size(1), -1)[index, :, rows*width + cols] = th_map_points(x, index, coords)
+        return self._to_b_c_h_w(x_offset, x_shape)
 
     @staticmethod
     def _get_grid(self, x):
-        batch_size, input_size= x.size(0), x.size(1)
-        dtype, cuda = x.data.type(), x.data.is_cuda
-        if self._grid_param == (batch_size, input_size, dtype, cuda):
-            return self._grid
-        self._grid_param = (batch_size, input_size, dtype, cuda)
-        self._grid = th_generate_grid(batch_size, input_size, dtype, cuda)
-        return self._grid
-    
+        return th_generate_grid((x.size(-2), x.size(-1)), th_accumulate_dtype(x.dtype), x.device)
+
     @staticmethod
     def _init_weights(weights, std):
-        fan_out = weights.size(0)
-        fan_in = weights.size(1) * weights.size(2) * weights.size(3)
-        w = np.random.normal(0.0, std, (fan_out, fan_in))
-        return torch.from_numpy(w.reshape(weights.size()))
+        # Drawn in the dtype of the weights, no float64 round trip
+        return weights.data.new_empty(weights.size()).normal_(0.0, std)
 
     @staticmethod
     def _to_bc_h_w_2(x, x_shape):
-        """(b, 2c, h, w) -> (b*c, h, w, 2)"""
+        """(b, 2g, h, w) -> (b*g, h, w, 2)"""
         x = x.contiguous().view(-1, int(x_shape[2]), int(x_shape[3]), 2)
         return x
 
@@ -81,8 +163,113 @@ class ConvOffset2D(nn.Conv2d):
         x = x.contiguous().view(-1, int(x_shape[2]), int(x_shape[3]))
         return x
 
+    @staticmethod
+    def _to_bg_cg_h_w(x, x_shape, groups):
+        """(b, c, h, w) -> (b*g, c/g, h, w)"""
+        x = x.contiguous().view(-1, int(x_shape[1]) // groups, int(x_shape[2]), int(x_shape[3]))
+        return x
+
     @staticmethod
     def _to_b_c_h_w(x, x_shape):
-        """(b*c, h, w) -> (b, c, h, w)"""
+        """(b*c, h, w) or (b*g, c/g, h, w) -> (b, c, h, w)"""
         x = x.contiguous().view(-1, int(x_shape[1]), int(x_shape[2]), int(x_shape[3]))
         return x
+
+
+class DeformConv2d(nn.Module):
+    """DeformConv2d
+
+    Deformable convolution: learns a 2D offset for every kernel tap, samples
+    the input at the shifted tap positions with bilinear interpolation and
+    accumulates one grouped matmul per tap. No k*k im2col columns are built,
+    in eval only one output-sized sample is alive at a time. The offsets are per tap,
+    so it samples k*k maps where ConvOffset2D followed by nn.Conv2d samples
+    one, but with few offset fields its offset conv is far smaller than
+    ConvOffset2D's per-channel one. See benchmark_deform.py for both
+
+    With zero offsets (the initialization) it is equal to nn.Conv2d. For
+    float16/bfloat16 inputs the sampling positions stay in float32. Like
+    ConvOffset2D, the output keeps the memory format of the input
+    """
+    def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1,
+                 dilation=1, groups=1, bias=False, offset_groups=None):
+        """Init
+
+        Parameters
+        ----------
+        in_channels, out_channels, kernel_size, stride, padding, dilation, groups, bias:
+            As in nn.Conv2d, kernel is square
+        offset_groups : int
+            Number of offset fields, each shared by in_channels/offset_groups
+            channels. 0: one field per channel, as in ConvOffset2D. None (the
+            default): one field shared by all channels, a per-channel field
+            needs in_channels*k*k*2 offset outputs
+        """
+        super(DeformConv2d, self).__init__()
+        if offset_groups is None:
+            offset_groups = 1
+        offset_groups = offset_groups or in_channels
+        assert in_channels % groups == 0 and out_channels % groups == 0
+        assert offset_groups > 0 and in_channels % offset_groups == 0
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.groups = groups
+        self.offset_groups = offset_groups
+
+        self.weight = nn.Parameter(torch.empty(out_channels, in_channels // groups, kernel_size, kernel_size))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_channels))
+        else:
+            self.register_parameter('bias', None)
+
+        # Offsets: (b, offset_groups*k*k*2, h_out, w_out)
+        n_offsets = offset_groups * kernel_size * kernel_size * 2
+        self.offset_weight = nn.Parameter(torch.empty(n_offsets, in_channels, kernel_size, kernel_size))
+        self.offset_bias = nn.Parameter(torch.empty(n_offsets))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        n = self.in_channels // self.groups * self.kernel_size * self.kernel_size
+        stdv = 1. / math.sqrt(n)
+        self.weight.data.uniform_(-stdv, stdv)
+        if self.bias is not None:
+            self.bias.data.uniform_(-stdv, stdv)
+        self.offset_weight.data.zero_()
+        self.offset_bias.data.zero_()
+
+    def forward(self, x):
+        b, c, h, w = x.size()
+        k, og, g = self.kernel_size, self.offset_groups, self.groups
+        memory_format = _memory_format(x)
+        x = x.contiguous()
+
+        offsets = F.conv2d(x, self.offset_weight, self.offset_bias, stride=self.stride,
+                           padding=self.padding, dilation=self.dilation)
+        h_out, w_out = offsets.size(2), offsets.size(3)
+        n_cols = h_out * w_out
+
+        # offsets: (b*og, k*k, h_out*w_out, 2), grid: (1, k*k, h_out*w_out, 2)
+        offsets = offsets.view(b * og, k * k, 2, n_cols).transpose(2, 3)
+        grid = th_generate_conv_grid((h_out, w_out), k, self.stride, self.dilation,
+                                     th_accumulate_dtype(x.dtype), x.device).view(1, k * k, n_cols, 2)
+
+        if self.padding > 0:
+            x = F.pad(x, [self.padding] * 4)
+        x = x.view(b * og, c // og, x.size(2), x.size(3))
+
+        # One tap at a time: (g, out/g, c/g) x (b, g, c/g, h_out*w_out) summed over the k*k taps,
+        # so no k*k im2col columns, in eval only one output-sized sample (and its corners) is alive
+        weight = self.weight.view(g, self.out_channels // g, c // g, k * k).permute(3, 0, 1, 2).contiguous()
+        out = None
+        for tap in range(k * k):
+            samples = th_batch_map_coordinates(x, offsets[:, tap] + grid[:, tap])
+            tap_out = torch.matmul(weight[tap], samples.view(b, g, c // g, n_cols))
+            out = tap_out if out is None else out + tap_out
+        out = out.view(b, self.out_channels, h_out, w_out)
+        if self.bias is not None:
+            out = out + self.bias.view(1, -1, 1, 1)
+        return out.contiguous(memory_format=memory_format)
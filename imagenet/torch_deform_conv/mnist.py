@@ -1,32 +1,95 @@
 from __future__ import absolute_import, division
 
-from keras.datasets import mnist
-from keras.preprocessing.image import ImageDataGenerator
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+import torchvision.datasets as datasets
 
 
-def get_mnist_dataset():
-    (X_train, y_train), (X_test, y_test) = mnist.load_data()
-    X_train = X_train.astype('float32') / 255
-    X_test = X_test.astype('float32') / 255
-    X_train = X_train[..., None]
-    X_test = X_test[..., None]
-    Y_train = y_train
-    Y_test = y_test
+_mnist = {}
 
-    return (X_train, Y_train), (X_test, Y_test)
+
+def get_mnist_dataset(root='../data'):
+    """MNIST as in-memory tensors, loaded once per root
+
+    Returns ((X_train, Y_train), (X_test, Y_test)), X: float (n, 1, 28, 28)
+    in [0, 1] in shared memory so DataLoader workers do not copy it, Y: long (n,)
+    """
+    if root not in _mnist:
+        sets = []
+        for train in [True, False]:
+            mnist = datasets.MNIST(root, train=train, download=True)
+            X = mnist.data.float().div_(255).unsqueeze(1).share_memory_()
+            Y = mnist.targets.long().share_memory_()
+            sets.append((X, Y))
+        _mnist[root] = tuple(sets)
+    return _mnist[root]
+
+
+def th_random_affine(x, translate, scale):
+    """Random zoom/translate of a batch with one affine_grid/grid_sample call
+
+    Same ranges as keras ImageDataGenerator(zoom_range=scale,
+    width_shift_range=translate, height_shift_range=translate)
+    Parameters
+    ----------
+    x : torch.Tensor. shape = (b, c, h, w)
+    translate : float
+        Max shift as a fraction of the image size
+    scale : float
+        Zoom is drawn from [1 - scale, 1 + scale] per axis
+    """
+    batch_size = x.size(0)
+    theta = x.new_zeros(batch_size, 2, 3)
+    zoom = 1 + (x.new_empty(batch_size, 2).uniform_(-1, 1) * scale)
+    # normalized coords span 2, so a shift of t * size is 2 * t
+    shift = x.new_empty(batch_size, 2).uniform_(-1, 1) * translate * 2
+    theta[:, 0, 0] = zoom[:, 0]
+    theta[:, 1, 1] = zoom[:, 1]
+    theta[:, :, 2] = shift
+    grid = F.affine_grid(theta, x.size(), align_corners=False)
+    return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+class MNISTBatches(torch.utils.data.Dataset):
+    """In-memory dataset indexed by a list of indices, returns whole batches
+
+    Use with a BatchSampler so each batch is one tensor index plus one
+    batched augmentation, see get_gen
+    """
+    def __init__(self, X, Y, translate=0., scale=0.):
+        self.X = X
+        self.Y = Y
+        self.translate = translate
+        self.scale = scale
+
+    def __len__(self):
+        return self.X.size(0)
+
+    def __getitem__(self, inds):
+        inds = torch.as_tensor(inds)
+        X, Y = self.X[inds], self.Y[inds]
+        if self.translate > 0 or self.scale > 0:
+            X = th_random_affine(X, self.translate, self.scale)
+        return X, Y
 
 
 def get_gen(set_name, batch_size, translate, scale,
-            shuffle=True):
+            shuffle=True, num_workers=0, root='../data'):
+    """DataLoader of augmented (X, Y) batches, X: (b, 1, 28, 28)
+
+    One pass over the set per iteration, for ConvNet/DeformConvNet in cnn.py
+    """
     if set_name == 'train':
-        (X, Y), _ = get_mnist_dataset()
+        (X, Y), _ = get_mnist_dataset(root)
     elif set_name == 'test':
-        _, (X, Y) = get_mnist_dataset()
-
-    image_gen = ImageDataGenerator(
-        zoom_range=scale,
-        width_shift_range=translate,
-        height_shift_range=translate
-    )
-    gen = image_gen.flow(X, Y, batch_size=batch_size, shuffle=shuffle)
-    return gen
+        _, (X, Y) = get_mnist_dataset(root)
+
+    dataset = MNISTBatches(X, Y, translate=translate, scale=scale)
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False)
+    return torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None,
+                                       num_workers=num_workers)
@@ -0,0 +1,190 @@
+from __future__ import absolute_import, division
+
+import os
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def _to_host(t):
+    """CPU copy of t, into pinned memory without waiting for a CUDA t"""
+    if not t.is_cuda:
+        return t.clone()
+    host = torch.empty(t.size(), dtype=t.dtype, pin_memory=True)
+    return host.copy_(t, non_blocking=True)
+
+
+def _copy_event(t):
+    """CUDA event marking the end of the copies queued so far on t's device, None on CPU"""
+    if not t.is_cuda:
+        return None
+    event = torch.cuda.Event()
+    event.record()
+    return event
+
+
+class OffsetRecorder(object):
+    """OffsetRecorder
+
+    Records the offsets predicted by ConvOffset2D layers into a fixed-size
+    ring buffer, for inspecting offset fields of long training runs
+
+    Only the first `samples` items of a batch are kept, optionally average
+    pooled by `downsample` and quantized to int8 with a per-record scale, and
+    copied to the CPU, so the full (b, 2g, h, w) offsets are never retained.
+    Recording never waits for the device: the scale stays a tensor and the
+    copy into pinned memory is non-blocking, a record is only resolved (see
+    records) by the writer thread or the reader. With a `path`, a full buffer
+    is handed to a background thread that writes it as a compressed .npz
+    file, training does not wait for the disk
+
+    Usage
+    -----
+    recorder = OffsetRecorder(capacity=256, downsample=2, quantize=True, path='offsets')
+    recorder.attach(model)
+    ... train ...
+    recorder.close()
+    """
+    def __init__(self, capacity=256, every=100, samples=1, downsample=1, quantize=False,
+                 path=None, max_pending=4):
+        """Init
+
+        Parameters
+        ----------
+        capacity : int
+            Max number of records kept in memory, oldest are dropped first
+        every : int
+            Record every n-th forward of each layer, 1 records every step
+        samples : int
+            Number of batch items recorded per forward
+        downsample : int
+            Spatial average pooling factor applied before storing
+        quantize : bool
+            Store int8 values and a float scale instead of float32
+        path : str
+            Directory of the .npz store, None keeps records in memory only
+        max_pending : int
+            Max buffers waiting for the writer thread, further flushes are
+            dropped (and counted in self.dropped) rather than blocking
+        """
+        self.capacity = capacity
+        self.every = every
+        self.samples = samples
+        self.downsample = downsample
+        self.quantize = quantize
+        self.path = path
+        self.buffer = deque(maxlen=capacity)
+        self.dropped = 0
+        self._handles = []
+        self._calls = {}
+        self._n_files = 0
+        self._queue = None
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._writer = threading.Thread(target=self._write_loop)
+            self._writer.daemon = True
+            self._writer.start()
+
+    def attach(self, model, layers=None):
+        """Record the ConvOffset2D layers of model, all of them or the given names"""
+        from torch_deform_conv.layers import ConvOffset2D
+        for name, m in model.named_modules():
+            if isinstance(m, ConvOffset2D) and (layers is None or name in layers):
+                self._calls[name] = 0
+                self._handles.append(m.register_offset_hook(self._make_hook(name)))
+        return self
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _make_hook(self, name):
+        def hook(module, offsets):
+            step = self._calls[name]
+            self._calls[name] = step + 1
+            if step % self.every == 0:
+                self.record(name, step, offsets)
+        return hook
+
+    def record(self, name, step, offsets):
+        """Store offsets (b, 2g, h, w) of layer name at step, without waiting for the device"""
+        with torch.no_grad():
+            offsets = offsets[:self.samples].detach().float()
+            if self.downsample > 1:
+                offsets = F.avg_pool2d(offsets, self.downsample, ceil_mode=True)
+            if self.quantize:
+                scale = offsets.abs().max() / 127
+                scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+                offsets = torch.round(offsets / scale).to(torch.int8)
+            else:
+                scale = offsets.new_ones(())
+            self.buffer.append((name, step, _to_host(scale), _to_host(offsets), _copy_event(offsets)))
+        if self._queue is not None and len(self.buffer) == self.capacity:
+            self.flush()
+
+    @staticmethod
+    def _resolve(record):
+        name, step, scale, offsets, event = record
+        if event is not None:
+            event.synchronize()
+        return name, step, float(scale), offsets
+
+    def records(self):
+        """The buffered records as (name, step, scale, CPU offsets), waits for their copies"""
+        return [self._resolve(record) for record in self.buffer]
+
+    def flush(self):
+        """Hand the buffered records to the writer thread and clear the buffer"""
+        if self._queue is None or not self.buffer:
+            return
+        records = list(self.buffer)
+        self.buffer.clear()
+        try:
+            self._queue.put_nowait(records)
+        except queue.Full:
+            self.dropped += len(records)
+
+    def close(self):
+        """Flush, wait for pending writes, detach the hooks"""
+        self.detach()
+        if self._queue is not None:
+            self.flush()
+            self._queue.put(None)
+            self._writer.join()
+            self._queue = None
+
+    def _write_loop(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                return
+            arrays = {}
+            for i, (name, step, scale, offsets) in enumerate(self._resolve(r) for r in records):
+                key = '{0:05d}_{1}_{2}'.format(i, name.replace('.', '_'), step)
+                arrays[key] = offsets.numpy()
+                arrays[key + '_scale'] = np.float32(scale)
+            filename = os.path.join(self.path, 'offsets_{0:06d}.npz'.format(self._n_files))
+            np.savez_compressed(filename, **arrays)
+            self._n_files += 1
+
+
+def load_offsets(filename):
+    """Read a file of OffsetRecorder, returns a list of (key, float32 offsets)"""
+    data = np.load(filename)
+    records = []
+    for key in sorted(data.files):
+        if key.endswith('_scale'):
+            continue
+        records.append((key, data[key].astype(np.float32) * data[key + '_scale']))
+    return records
@@ -7,3 +7,24 @@ def transfer_weights(model_from, model_to):
         if not k in wf:
             wf[k] = wt[k]
     model_to.load_state_dict(wf)
+
+
+def set_offset_fast_path(model, threshold, tile=0):
+    """Enable the ConvOffset2D identity fast path in every layer of model"""
+    from torch_deform_conv.layers import ConvOffset2D
+    for m in model.modules():
+        if isinstance(m, ConvOffset2D):
+            m.set_fast_path(threshold, tile)
+
+
+def offset_fast_path_stats(model):
+    """Per-layer fast path statistics, name -> dict of counts and rates"""
+    from torch_deform_conv.layers import ConvOffset2D
+    stats = {}
+    for name, m in model.named_modules():
+        if isinstance(m, ConvOffset2D):
+            s = dict(m.fast_stats)
+            s['skipped_call_rate'] = s['skipped_calls'] / float(max(s['calls'], 1))
+            s['skipped_tile_rate'] = s['skipped_tiles'] / float(max(s['tiles'], 1))
+            stats[name] = s
+    return stats